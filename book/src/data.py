@@ -1,19 +1,76 @@
 # Import relevant libraries
 from pathlib import Path
+import numpy as np
 import pandas as pd
-from pandas.core.dtypes.inference import is_list_like
+from pandas.api.types import is_list_like
+from pandas.tseries.api import guess_datetime_format
    
 import ast
+import functools
+import hashlib
+import importlib.util
+import json
 import logging
+import os
+import tempfile
+import time
+import tracemalloc
+import warnings
 import datetime as dt
+from collections import OrderedDict
 
-DATA_DIR = Path.cwd().parents[0]/'data'
 FALSE_VALUES = ["No", "no", "n", "N"]
 TRUE_VALUES = ["Yes", "yes", "y", "Y"]
 
-TODAY = dt.datetime.today()
 _DEBUG = False
 
+# DATA_DIR and TODAY are computed on first use, see __getattr__
+_LAZY_CONSTANTS = {
+    "DATA_DIR": lambda: Path.cwd().parents[0]/'data',
+    "TODAY": dt.datetime.today,
+}
+
+
+def __getattr__(name):
+    if name in _LAZY_CONSTANTS:
+        value = _LAZY_CONSTANTS[name]()
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _data_dir() -> Path:
+    """
+    DATA_DIR, including a value assigned to it after import
+    """
+    return globals()["DATA_DIR"] if "DATA_DIR" in globals() else __getattr__("DATA_DIR")
+
+# orjson is optional, it parses JSON several times faster than json
+try:
+    from orjson import loads as _json_loads
+except ImportError:
+    _json_loads = json.loads
+
+# profiling of the functions decorated with `dump_df_desc`
+_PROFILE = False
+_PROFILE_DEEP_MEMORY = True
+_PROFILE_STARTED_TRACING = False
+_PROFILE_RECORDS = []
+_PROFILE_COLUMNS = [
+    "function", "description", "seconds", "rows_in", "rows_out", "columns_in",
+    "columns_out", "memory_in", "memory_out", "traced_delta", "traced_peak",
+]
+
+# registry with the column types of the datasets, in DATA_DIR
+SCHEMA_FILE = "schemas.json"
+_SCHEMAS = {}
+# read_csv arguments of the caller that keep the pyarrow engine, see `_schema_kwargs`
+_PYARROW_KWARGS = {"usecols", "dtype"}
+
+# number of datasets `load_data` and `load_excel` keep in memory
+DATA_CACHE_SIZE = 8
+_DATA_CACHE = OrderedDict()
+
 
 def _get_list(item, errors="ignore"):
     """
@@ -82,10 +139,108 @@ def _get_column_list(df, columns=None):
         )
 
 
+def enable_profiling(deep_memory: bool = True, trace_memory: bool = True):
+    """
+    Record a profile of every call to a function decorated with `dump_df_desc`
+    Parameters:
+    ----------
+    deep_memory : bool, default True
+        measure the memory of the dataframes with `memory_usage(deep=True)`, which
+        has to inspect every string value
+    trace_memory : bool, default True
+        measure the memory allocated while running the function with tracemalloc
+    """
+    global _PROFILE, _PROFILE_DEEP_MEMORY, _PROFILE_STARTED_TRACING
+    _PROFILE = True
+    _PROFILE_DEEP_MEMORY = deep_memory
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        _PROFILE_STARTED_TRACING = True
+
+
+def disable_profiling():
+    """
+    Stop recording profiles, the records collected so far are kept
+    """
+    global _PROFILE, _PROFILE_STARTED_TRACING
+    _PROFILE = False
+    if _PROFILE_STARTED_TRACING:
+        tracemalloc.stop()
+        _PROFILE_STARTED_TRACING = False
+
+
+def clear_profile():
+    """
+    Remove the records collected so far
+    """
+    _PROFILE_RECORDS.clear()
+
+
+def get_profile() -> pd.DataFrame:
+    """
+    The profile records, one row per call of a decorated function
+    Return:
+    ------
+    DataFrame
+        with the function, description, seconds, rows_in, rows_out, columns_in, columns_out,
+        memory_in, memory_out (bytes of the dataframes), traced_delta and traced_peak
+        (bytes allocated during the call, if tracemalloc was running)
+    """
+    return pd.DataFrame(_PROFILE_RECORDS, columns=_PROFILE_COLUMNS)
+
+
+def export_profile(path=None) -> str:
+    """
+    The profile records as json, written to `path` if it is provided
+    """
+    text = json.dumps(_PROFILE_RECORDS, indent=2, default=str)
+    if path is not None:
+        Path(path).write_text(text)
+    return text
+
+
+def _frame_memory(df: pd.DataFrame):
+    return int(df.memory_usage(deep=_PROFILE_DEEP_MEMORY).sum())
+
+
+def _profile_call(func, description, dataframe, args, kwargs):
+    """
+    Run func and add a record of its runtime, memory and shape to the profile
+    """
+    memory_in = _frame_memory(dataframe)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    ret_val = func(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    if tracing:
+        traced_after, traced_peak = tracemalloc.get_traced_memory()
+    result = dataframe if ret_val is None else ret_val
+    _PROFILE_RECORDS.append({
+        "function": func.__name__,
+        "description": description,
+        "seconds": seconds,
+        "rows_in": dataframe.shape[0],
+        "rows_out": result.shape[0],
+        "columns_in": dataframe.shape[1],
+        "columns_out": result.shape[1],
+        "memory_in": memory_in,
+        "memory_out": _frame_memory(result),
+        "traced_delta": traced_after - traced_before if tracing else None,
+        "traced_peak": traced_peak - traced_before if tracing else None,
+    })
+    return ret_val
+
+
 def dump_df_desc(description=""):
     """
     This is a decorator to log the shape of the dataframe prior to running 
-    the function and also after running a function
+    the function and also after running a function.
+    When profiling is enabled (see `enable_profiling`) the runtime, memory and
+    shape of each call are recorded as well, see `get_profile`.
+    Without debug logging or profiling only the description is logged.
     Parameters
     ----------
     description : str
@@ -107,14 +262,28 @@ def dump_df_desc(description=""):
     def wrap(func):
         fname = func.__name__
 
+        @functools.wraps(func)
         def echo_func(*args, **kwargs):
             logging.info(description)
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+            if not (debug or _PROFILE):
+                return func(*args, **kwargs)
             dataframe = args[0]
+            if not debug:
+                return _profile_call(func, description, dataframe, args, kwargs)
             logging.debug(f"Shape prior to {fname}:{dataframe.shape}")
             cols = set(dataframe.columns)
-            ret_val = func(*args, **kwargs)
-            logging.debug(f"Shape after running {fname}:{ret_val.shape}")
-            cols_after = set(ret_val.columns)
+            if _PROFILE:
+                ret_val = _profile_call(func, description, dataframe, args, kwargs)
+            else:
+                ret_val = func(*args, **kwargs)
+            # functions changing the dataframe inplace return None
+            result = dataframe if ret_val is None else ret_val
+            logging.debug(f"Shape after running {fname}:{result.shape}")
+            rows_removed = dataframe.shape[0] - result.shape[0]
+            if rows_removed > 0:
+                logging.debug(f"Rows removed: {rows_removed}")
+            cols_after = set(result.columns)
             col_diff = cols.difference(cols_after)
             if len(col_diff) == 0:
                 logging.debug("No columns dropped.")
@@ -180,10 +349,28 @@ def remove_columns(df, columns, errors="ignore"):
     return df.drop(columns=drop_columns, errors=errors)
 
 
+def _to_boolean_masks(block, true_values, false_values):
+    """
+    Compare a 2-D block of values to the true and false values
+    Return:
+    ------
+    (is_true, is_na) boolean arrays with the shape of the block
+    """
+    if block.dtype.kind in "biuf":
+        is_true = block == 1
+        is_na = ~(is_true | (block == 0))
+    else:
+        is_true = np.isin(block, true_values)
+        is_na = ~(is_true | np.isin(block, false_values))
+    return is_true, is_na
+
+
 @dump_df_desc(description="Convert columns to True/False from 1/0")
-def convert_to_bool(df, columns, inplace:bool=False):
+def convert_to_bool(df, columns, inplace:bool=False, true_values=None, false_values=None):
     """
-    Convert the list of columns, provided in the
+    Convert the list of columns provided to the nullable boolean dtype.
+    Numeric columns map 1 to True and 0 to False, text columns use `true_values`
+    and `false_values`. Any other value becomes NA.
     
     Parameters:
     ----------
@@ -192,19 +379,34 @@ def convert_to_bool(df, columns, inplace:bool=False):
     columns : str or list-like
         columns that are in-scope for the change, 
         if None or 'all' then all columns
+    inplace : bool, default false
+        if True, then change the dataset provided and return None
+        otherwise return a changed copy of the dataset
+    true_values : list-like, default TRUE_VALUES
+        text values (in addition to 1) that are converted to True
+    false_values : list-like, default FALSE_VALUES
+        text values (in addition to 0) that are converted to False
     Return:
     ------
     The modified dataframe
     """
-    d_map = {0: False, 1: True}
-    for col in _get_column_list(df, columns):
-        if df[col].dtype != "bool":
-            logging.debug(f"Converting column to boolean - {col}")
-            df[col] = df[col].map(d_map, na_action="ignore")
-            df[col] = df[col].convert_dtypes(
-                infer_objects=False, convert_string=False, convert_integer=False
-            )
-    return df
+    true_values = [1] + list(TRUE_VALUES if true_values is None else true_values)
+    false_values = [0] + list(FALSE_VALUES if false_values is None else false_values)
+    data = df if inplace else df.copy()
+    cols = [col for col in _get_column_list(df, columns) if df[col].dtype not in ("bool", "boolean")]
+    numeric_cols = [col for col in cols if pd.api.types.is_numeric_dtype(df[col])]
+    text_cols = [col for col in cols if col not in numeric_cols]
+    logging.debug(f"Converting columns to boolean - {cols}")
+
+    # convert all columns of a kind in one block
+    for block_cols, dtype in ((numeric_cols, "float64"), (text_cols, "object")):
+        if len(block_cols) == 0:
+            continue
+        block = df[block_cols].to_numpy(dtype=dtype, na_value=np.nan)
+        is_true, is_na = _to_boolean_masks(block, true_values, false_values)
+        for i, col in enumerate(block_cols):
+            data[col] = pd.arrays.BooleanArray(is_true[:, i], is_na[:, i])
+    return None if inplace else data
 
 
 @dump_df_desc(description="Convert boolean columns to 1/0")
@@ -224,19 +426,25 @@ def convert_from_bool(df, columns, true_value=1, false_value=0,inplace:bool=Fals
     false_value : any, default 0
         the value to use in place of False in new dataframe
     inplace : bool, default false
-        if True, then change the dataset provided
-        otherwise return the dataset
+        if True, then change the dataset provided and return None
+        otherwise return a changed copy of the dataset
     Return:
     ------
     The modified dataframe
     """
-    d_map = {False: false_value, True: true_value}
-    for col in _get_column_list(df, columns):
-        if df[col].dtype == "bool":
-            logging.debug(f"Converting column from boolean - {col}")
-            df[col] = df[col].map(d_map, na_action="ignore")
-    return None if inplace else df
-    
+    data = df if inplace else df.copy()
+    cols = [col for col in _get_column_list(df, columns) if df[col].dtype in ("bool", "boolean")]
+    if len(cols) == 0:
+        return None if inplace else data
+    logging.debug(f"Converting columns from boolean - {cols}")
+
+    is_true = df[cols].to_numpy(dtype=bool, na_value=False)
+    is_na = df[cols].isna().to_numpy()
+    values = np.where(is_true, true_value, false_value)
+    for i, col in enumerate(cols):
+        column = pd.Series(values[:, i], index=df.index)
+        data[col] = column.mask(is_na[:, i]) if is_na[:, i].any() else column
+    return None if inplace else data
 
 
 @dump_df_desc(description="Convert columns to date columns")
@@ -326,23 +534,33 @@ def remove_na_rows(df, how="any", threshold=None, subset=None):
 
 
 # TODO: Write a test for this function
-@dump_df_desc("Removing duplicate columns based on index")
-def remove_duplicates(df):
+@dump_df_desc("Removing duplicate rows")
+def remove_duplicates(df, subset=None, keep="first"):
     """
     Remove duplicated rows
-    Where there is more than one row that have the same index value,
-    this function will create a dataframe with only one copy of that
-    row.
+    Where there is more than one row that have the same index value
+    (or the same values in the `subset` columns), this function will
+    create a dataframe with only one copy of that row.
+    The rows are found by hashing, so the dataframe is not sorted and
+    the remaining rows keep their original order.
     Parameters:
     ----------
     df : DataFrame
         the DataFrame to work on
+    subset : str or list-like, default None
+        columns that identify duplicates, if None then the index
+    keep : {'first', 'last'}, default 'first'
+        which of the duplicated rows to keep
     
     Return:
     ------
     The modified dataframe
     """
-    return df.groupby(df.index).first()
+    if subset is None:
+        duplicated = df.index.duplicated(keep=keep)
+    else:
+        duplicated = df.duplicated(subset=_get_list(subset), keep=keep).to_numpy()
+    return df[~duplicated]
 
 
 def count_empty_rows(df, column):
@@ -352,27 +570,125 @@ def count_empty_rows(df, column):
     ----------
     df : DataFrame
         the DataFrame to work on
-    columns : str or list-like
+    column : str or list-like
         columns that are in-scope for the change, 
         if None or 'all' then all columns
     Return:
     ------
-    int
+    int, or a Series with the count for each column if there is more than one
         the number of rows that are NA or have a 0 value
     """
-    return (df[column].isna().sum()) + (df[column] == 0).sum()
+    profile = profile_missing(df, column, distinct=False)
+    counts = profile["n_na"] + profile["n_zero"]
+    single = column is not None and not is_list_like(column) and column != "all"
+    return counts.iloc[0] if single else counts
+
+
+def _estimate_distinct(sample: pd.Series, n_rows: int) -> float:
+    """
+    Estimate the number of distinct values of a column from a random sample
+    (the GEE estimator of Charikar et al.)
+    """
+    frequencies = sample.value_counts(dropna=True)
+    singletons = (frequencies == 1).sum()
+    scale = np.sqrt(n_rows / max(len(sample), 1))
+    return round(scale * singletons + (len(frequencies) - singletons))
+
+
+def profile_missing(df, columns="all", distinct=True, sample=None, random_state=None):
+    """
+    Data quality profile of the columns, computed for all columns at once:
+    the number of NA values, zeros, empty strings and distinct values and the
+    minimum and maximum of numeric and date columns.
+    Parameters:
+    ----------
+    df : DataFrame
+        the DataFrame to work on
+    columns : str or list-like
+        columns that are in-scope for the change, 
+        if None or 'all' then all columns
+    distinct : bool, default True
+        count the distinct values
+    sample : int, optional
+        estimate the distinct values from a random sample of this many rows,
+        instead of hashing every value
+    random_state : int, optional
+        seed for the sample
+    Return:
+    ------
+    DataFrame
+        one row per column with dtype, n_na, n_zero, n_empty, n_distinct, min and max
+    """
+    selected = set(_get_column_list(df, columns))
+    cols = [c for c in df.columns if c in selected]
+    data = df[cols]
+    dtypes = data.dtypes
+    profile = pd.DataFrame(
+        {"dtype": dtypes.astype(str), "n_na": data.isna().sum(), "n_zero": 0, "n_empty": 0,
+         "n_distinct": np.nan, "min": None, "max": None},
+        index=pd.Index(cols),
+    )
+
+    numeric = [c for c in cols if pd.api.types.is_numeric_dtype(dtypes[c])]
+    if numeric:
+        block = _numeric_block(data, numeric)
+        with warnings.catch_warnings():
+            # columns that are all NA
+            warnings.simplefilter("ignore", RuntimeWarning)
+            profile.loc[numeric, "n_zero"] = (block == 0).sum(axis=0)
+            profile.loc[numeric, "min"] = np.nanmin(block, axis=0)
+            profile.loc[numeric, "max"] = np.nanmax(block, axis=0)
+        # integers exactly and with their own type, the float block rounds above 2**53
+        integers = [c for c in numeric if pd.api.types.is_integer_dtype(dtypes[c])]
+        if integers:
+            profile.loc[integers, "min"] = data[integers].min().astype(object)
+            profile.loc[integers, "max"] = data[integers].max().astype(object)
+
+    dates = [c for c in cols if pd.api.types.is_datetime64_any_dtype(dtypes[c])]
+    if dates:
+        profile.loc[dates, "min"] = data[dates].min()
+        profile.loc[dates, "max"] = data[dates].max()
+
+    text = [c for c in cols if c not in numeric and c not in dates]
+    if text:
+        block = data[text].to_numpy(dtype=object)
+        profile.loc[text, "n_empty"] = (block == "").sum(axis=0)
+
+    if distinct:
+        if sample is not None and sample < len(data):
+            rows = data.sample(n=sample, random_state=random_state)
+            profile["n_distinct"] = [_estimate_distinct(rows[c], len(data)) for c in cols]
+        else:
+            profile["n_distinct"] = data.nunique()
+    return profile
+
+
+def _parse_dict_text(text):
+    """
+    Parse the text representation of a dict (or other literal).
+    JSON is tried first as it is much faster, then python literals, e.g. single
+    quoted strings or True/None. Nothing is evaluated, so the text can't run code.
+    """
+    try:
+        return _json_loads(text)
+    except ValueError:
+        return ast.literal_eval(text)
 
 
 def get_dict_from_string(s):
+    """
+    Parse a dict from its text representation, returning an empty dict
+    (and logging the error) if the text can't be parsed
+    """
     try:
-        d = eval(s)
+        d = _parse_dict_text(s)
     except Exception as e:
         d = {}
         logging.error(e)
     return d
 
 
-def split_merged(df):
+def split_merged(df, indicator="_merge"):
     """
     Given a merged dataset return the two parts (those that matched
     and those that didn't)
@@ -381,27 +697,66 @@ def split_merged(df):
     ----------
     df : DataFrame
         the DataFrame to work on
+    indicator : str, default "_merge"
+        name of the indicator column added by `merge(indicator=True)`
     Return:
     ------
-    The modified dataframe
+    tuple of DataFrame
+        the rows found in both frames and the remaining rows, 
+        without the indicator column
     """
-    df_missing = df[df["_merge"] != "both"]
-    df = df[df["_merge"] == "both"]
-    df.drop(columns=["_merge"], errors="ignore", inplace=True)
-    df_missing.drop(columns=["_merge"], errors="ignore", inplace=True)
-    return df, df_missing
+    merged = df[indicator]
+    if isinstance(merged.dtype, pd.CategoricalDtype):
+        # compare the integer codes instead of the labels
+        both = merged.cat.codes.to_numpy() == merged.cat.categories.get_loc("both")
+    else:
+        both = merged.to_numpy() == "both"
+    # a single positional take per partition, the indicator column is never copied
+    keep = np.flatnonzero(df.columns != indicator)
+    return df.iloc[np.flatnonzero(both), keep], df.iloc[np.flatnonzero(~both), keep]
+
+
+def merge_and_split(left, right, **merge_kwargs):
+    """
+    Merge two frames and return the two parts (those that matched
+    and those that didn't), see `split_merged`
+
+    Parameters:
+    ----------
+    left : DataFrame
+    right : DataFrame
+    merge_kwargs : 
+        passed on to `pd.merge`, `indicator` may be used to name the indicator column
+    Return:
+    ------
+    tuple of DataFrame
+        the rows found in both frames and the remaining rows
+    """
+    indicator = merge_kwargs.pop("indicator", None)
+    if not isinstance(indicator, str):
+        indicator = "_merge"
+    merged = pd.merge(left, right, indicator=indicator, **merge_kwargs)
+    return split_merged(merged, indicator)
 
 
 # TODO: Need a test for this method
 def force_data_types(df, map, columns="all", errors="ignore"):
     """
+    Convert columns to the data types given in `map`
     Parameters:
     ----------
     df : DataFrame
         the DataFrame to work on
+    map : dict
+        column name to data type. Besides the dtypes accepted by `astype`:
+        'date' converts to datetime64 with only the date part,
+        'datetime' converts to datetime64,
+        'bool' or 'boolean' converts with `convert_to_bool` (1/0, TRUE_VALUES/FALSE_VALUES)
     columns : str or list-like
         columns that are in-scope for the change, 
         if None or 'all' then all columns
+    errors: {'ignore', 'raise'}, default 'ignore'
+        If a column can't be converted, either leave it unchanged or raise the error
     Return:
     ------
     The modified dataframe
@@ -412,14 +767,77 @@ def force_data_types(df, map, columns="all", errors="ignore"):
         if col_type is None:
             logging.debug(f"No conversion available for column {c}.")
             continue
-        if col_type == "date":
-            df[c] = pd.to_datetime(df[c]).date()
-        else:
-            df[c] = df[c].as_type(col_type)
+        try:
+            if col_type == "date":
+                df[c] = pd.to_datetime(df[c]).dt.normalize()
+            elif col_type == "datetime":
+                df[c] = pd.to_datetime(df[c])
+            elif col_type in ("bool", "boolean"):
+                convert_to_bool(df, c, inplace=True)
+            else:
+                df[c] = df[c].astype(col_type)
+        except (ValueError, TypeError) as e:
+            if errors == "raise":
+                raise
+            logging.debug(f"Unable to convert column {c} to {col_type}: {e}")
+    return df
+
 
+_INTEGER_TYPES = ["int8", "int16", "int32", "int64"]
 
-def text_to_dict(df, columns="all"):
+
+def _compact_dtype(column: pd.Series, category_threshold: float):
+    """
+    The narrowest data type that holds all values of the column, in the format
+    used by `force_data_types`, or None if the current type can't be improved
     """
+    values = column.dropna()
+    if len(values) == 0 or isinstance(column.dtype, pd.CategoricalDtype):
+        return None
+    if pd.api.types.is_bool_dtype(column.dtype) or pd.api.types.is_datetime64_any_dtype(column.dtype):
+        return None
+    if pd.api.types.is_integer_dtype(column.dtype):
+        low, high = values.min(), values.max()
+        for int_type in _INTEGER_TYPES:
+            info = np.iinfo(int_type)
+            if info.min <= low and high <= info.max:
+                nullable = isinstance(column.dtype, pd.api.extensions.ExtensionDtype)
+                int_type = int_type.capitalize() if nullable else int_type
+                return None if int_type == column.dtype else int_type
+    if pd.api.types.is_float_dtype(column.dtype):
+        if column.dtype == np.float32:
+            return None
+        as_float64 = values.to_numpy(dtype=np.float64)
+        # only if no precision is lost
+        if np.array_equal(as_float64.astype(np.float32).astype(np.float64), as_float64):
+            return "float32"
+        return None
+    if pd.api.types.is_numeric_dtype(column.dtype):
+        return None
+
+    # text columns
+    distinct = pd.unique(values)
+    if set(distinct) <= set(TRUE_VALUES + FALSE_VALUES):
+        return "bool"
+    sample = pd.Series(distinct[:100])
+    if sample.map(lambda v: isinstance(v, str) and any(sep in v for sep in "-/:")).all():
+        # only dates in a consistent format, which pandas infers from the first value
+        date_format = guess_datetime_format(sample[0])
+        if (date_format is not None
+                and pd.to_datetime(values, format=date_format, errors="coerce").notna().all()):
+            return "datetime"
+    if len(distinct) <= category_threshold * len(values):
+        return "category"
+    return None
+
+
+def optimize_dtypes(df, columns="all", category_threshold=0.5, inplace=False, report=False):
+    """
+    Reduce the memory of a dataframe by converting each column to the narrowest
+    data type that holds its values (using `force_data_types`):
+    integers to the smallest integer type, floats to float32 if no precision is lost,
+    yes/no text columns (TRUE_VALUES/FALSE_VALUES) to boolean, date-like text to
+    datetime64 and text columns with few distinct values to category.
     
     Parameters:
     ----------
@@ -428,15 +846,79 @@ def text_to_dict(df, columns="all"):
     columns : str or list-like
         columns that are in-scope for the change, 
         if None or 'all' then all columns
+    category_threshold : float, default 0.5
+        convert text columns with at most this fraction of distinct values to category
+    inplace : bool, default False
+        if True, then change the dataset provided and return None
+    report : bool, default False
+        if True, also return a DataFrame with the old and new dtype and the bytes
+        saved for every converted column
+    Return:
+    ------
+    The modified dataframe, or (dataframe, report)
+    """
+    data = df if inplace else df.copy()
+    cols = _get_column_list(df, columns)
+    dtype_map = {}
+    for c in cols:
+        compact = _compact_dtype(df[c], category_threshold)
+        if compact is not None:
+            dtype_map[c] = compact
+    memory_before = df[list(dtype_map)].memory_usage(deep=True, index=False)
+    old_dtypes = df.dtypes[list(dtype_map)].astype(str)
+    force_data_types(data, dtype_map, columns=list(dtype_map))
+    result = None if inplace else data
+    if not report:
+        return result
+    memory_after = data[list(dtype_map)].memory_usage(deep=True, index=False)
+    savings = pd.DataFrame({
+        "old_dtype": old_dtypes,
+        "new_dtype": data.dtypes[list(dtype_map)].astype(str),
+        "bytes_before": memory_before,
+        "bytes_after": memory_after,
+        "bytes_saved": memory_before - memory_after,
+    })
+    return result, savings
+
+
+def text_to_dict(df, columns="all", expand=False):
+    """
+    Convert columns with the text representation of dicts (JSON or python literals)
+    to dicts, or expand them into one column per key.
+    Each distinct text is parsed only once, so rows with the same text share the
+    same dict object. Missing values become empty dicts.
+    
+    Parameters:
+    ----------
+    df : DataFrame
+        the DataFrame to work on
+    columns : str or list-like
+        columns that are in-scope for the change, 
+        if None or 'all' then all columns
+    expand : bool, default False
+        if True, replace each column with typed columns named `{column}_{key}`
+        (nested keys are joined with `_`), instead of a column of dicts
     Return:
     ------
     The modified dataframe
     """
     cols = _get_column_list(df, columns)
     for column in cols:
-        df[column] = df[column].apply(
-            lambda x: {} if pd.isna(x) else ast.literal_eval(x)
-        )
+        # parse the distinct values only; missing values get code -1
+        codes, uniques = pd.factorize(df[column])
+        parsed = [_parse_dict_text(text) for text in uniques]
+        if not expand:
+            values = np.empty(len(parsed) + 1, dtype=object)
+            values[:-1] = parsed
+            values[-1] = {}
+            df[column] = values[codes]
+            continue
+        expanded = pd.json_normalize(parsed + [{}], sep="_")
+        expanded = expanded.take(np.where(codes < 0, len(parsed), codes)).infer_objects()
+        position = df.columns.get_loc(column)
+        df.drop(columns=column, inplace=True)
+        for offset, key in enumerate(expanded.columns):
+            df.insert(position + offset, f"{column}_{key}", expanded[key].to_numpy())
     return df
 
 # def reorder_columns(df: pd.DataFrame, fixed_columns:Union[str, Sequence[str]])->pd.DataFrame:
@@ -472,34 +954,651 @@ def text_to_dict(df, columns="all"):
 #     '''
 
 
-def load_data(fileName: str, **kwargs) -> pd.DataFrame:
-    data_file = DATA_DIR/f'{fileName}.csv'
-    print(data_file)
-    return pd.read_csv(DATA_DIR / f"{fileName}.csv", **kwargs)
+def _cache_key(source: Path, kwargs: dict) -> str:
+    """
+    Key for a cached dataset, changes when the source file, the reader arguments or
+    the pandas version change
+    """
+    stat = source.stat()
+    settings = sorted((k, repr(v)) for k, v in kwargs.items())
+    payload = repr((source.name, stat.st_mtime_ns, stat.st_size, settings, pd.__version__))
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
 
 
-def load_excel(fileName: str, **kwargs) -> pd.DataFrame:
-    return pd.read_excel(DATA_DIR / f"{fileName}.xlsx", **kwargs)
+def _write_sidecar(df: pd.DataFrame, sidecar: Path):
+    """
+    Pickle df to a temporary file and move it into place, so readers never see a partial file
+    """
+    try:
+        sidecar.parent.mkdir(exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=sidecar.parent, prefix=f".{sidecar.stem}-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                df.to_pickle(f)
+            os.replace(temp, sidecar)
+        except BaseException:
+            os.unlink(temp)
+            raise
+    except OSError as e:
+        logging.debug(f"Unable to write the cache for {sidecar.name}: {e}")
 
 
-def normalize(df:pd.DataFrame, columns, drop_old=False)-> pd.DataFrame:
-    data = df.copy(deep=True)
-    for c in columns:
-        new_column_name = f"{c}_NORM"
-        data[new_column_name] = (data[c] - data[c].min()) / (data[c].max() - data[c].min())
-    if drop_old:
-        data.drop(columns=columns,inplace=True)
-    return data
+def _read_cached(source: Path, reader, cache: bool = True, **kwargs) -> pd.DataFrame:
+    """
+    Read a dataset with `reader`, reusing earlier results
+    
+    The parsed DataFrame is stored as a pickle next to the source file (in a `.cache`
+    folder), keyed on the modification time and size of the source and the reader
+    arguments, and kept in memory for the most recently used datasets. Every call
+    returns a new copy, so callers can change it freely.
+    Parameters:
+    ----------
+    source : Path
+        the file to read
+    reader : callable
+        the pandas reader for the file, e.g. pd.read_csv
+    cache : bool, default True
+        if False, always parse the source file
+    
+    Return:
+    ------
+    DataFrame
+    """
+    # iterators and callables (no stable key) are not cached
+    if (not cache or kwargs.get("chunksize") or kwargs.get("iterator")
+            or any(callable(v) for v in kwargs.values())):
+        return reader(source, **kwargs)
+
+    key = _cache_key(source, kwargs)
+    if key in _DATA_CACHE:
+        _DATA_CACHE.move_to_end(key)
+        return _DATA_CACHE[key].copy()
+
+    sidecar = source.parent / ".cache" / f"{source.stem}-{key}.pkl"
+    df = None
+    if sidecar.exists():
+        logging.debug(f"Loading {source.name} from {sidecar}")
+        try:
+            df = pd.read_pickle(sidecar)
+        except Exception as e:
+            # a damaged sidecar is replaced below
+            logging.debug(f"Unable to read the cache for {source.name}: {e}")
+    if df is None:
+        df = reader(source, **kwargs)
+        _write_sidecar(df, sidecar)
+
+    _DATA_CACHE[key] = df
+    while len(_DATA_CACHE) > DATA_CACHE_SIZE:
+        _DATA_CACHE.popitem(last=False)
+    return df.copy()
+
+
+def clear_data_cache(files: bool = False):
+    """
+    Empty the in-memory cache of `load_data` and `load_excel`
+    Parameters:
+    ----------
+    files : bool, default False
+        if True, also delete the cached files from the `.cache` folder in DATA_DIR
+    """
+    _DATA_CACHE.clear()
+    if files:
+        folder = _data_dir() / ".cache"
+        # .tmp files are left behind by writes that were interrupted
+        for sidecar in [*folder.glob("*.pkl"), *folder.glob(".*.tmp")]:
+            sidecar.unlink()
+
+
+def build_schema(df: pd.DataFrame, category_threshold: float = 0.5) -> dict:
+    """
+    Profile a dataset for the schema registry used by `load_data`
+    Parameters:
+    ----------
+    df : DataFrame
+        the dataset as read by pd.read_csv without any options
+    category_threshold : float, default 0.5
+        see `optimize_dtypes`
+    Return:
+    ------
+    dict
+        for every column, the dtype pandas infers ("object" for text) and the compact
+        dtype of `optimize_dtypes` (with the category levels for categories)
+    """
+    columns = {}
+    for c in df.columns:
+        dtype = df[c].dtype
+        info = {"dtype": "object" if not pd.api.types.is_numeric_dtype(dtype) else str(dtype)}
+        compact = _compact_dtype(df[c], category_threshold)
+        if compact is not None:
+            info["compact"] = compact
+        if compact == "category":
+            levels = pd.unique(df[c].dropna()).tolist()
+            try:
+                info["levels"] = sorted(levels)
+            except TypeError:
+                info["levels"] = levels
+        columns[str(c)] = info
+    return {"columns": columns}
+
+
+def _load_schemas() -> dict:
+    """
+    The schema registry of the datasets in DATA_DIR, empty if there is none
+    """
+    path = _data_dir() / SCHEMA_FILE
+    if not path.exists():
+        return {}
+    mtime = path.stat().st_mtime_ns
+    if _SCHEMAS.get("path") != path or _SCHEMAS.get("mtime") != mtime:
+        _SCHEMAS.update(path=path, mtime=mtime, schemas=json.loads(path.read_text()))
+    return _SCHEMAS["schemas"]
+
+
+_FILE_DIGESTS = {}
+
+
+def _file_digest(path: Path) -> str:
+    """
+    sha1 of the contents of a file, remembered while the file is unchanged
+    """
+    stat = path.stat()
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if key not in _FILE_DIGESTS:
+        _FILE_DIGESTS[key] = hashlib.sha1(path.read_bytes()).hexdigest()
+    return _FILE_DIGESTS[key]
+
+
+def _schema_is_current(schema: dict, path: Path) -> bool:
+    """
+    Whether the registry entry was built from this version of the file
+    """
+    if "size" in schema and schema["size"] != path.stat().st_size:
+        return False
+    return "sha1" not in schema or schema["sha1"] == _file_digest(path)
+
+
+def _schema_kwargs(schema: dict, columns, compact: bool, kwargs: dict):
+    """
+    The read_csv arguments for a dataset from its schema; kwargs given by the caller win
+    Return:
+    ------
+    (read_csv arguments, columns to convert to boolean after reading)
+    """
+    caller_dtype = kwargs.pop("dtype", None)
+    if caller_dtype is not None and not isinstance(caller_dtype, dict):
+        # a single dtype for all columns replaces the schema types
+        return {"dtype": caller_dtype, **kwargs}, []
+    caller_dtype = caller_dtype or {}
+    selected = schema["columns"]
+    if columns is not None:
+        selected = {c: selected[c] for c in columns if c in selected}
+    dtype, parse_dates, booleans = {}, [], []
+    for c, info in selected.items():
+        target = info.get("compact") if compact else None
+        if target == "category":
+            dtype[c] = pd.CategoricalDtype(info["levels"])
+        elif target == "datetime":
+            parse_dates.append(c)
+        elif target == "bool":
+            booleans.append(c)
+        elif target is not None:
+            dtype[c] = target
+        elif info["dtype"] != "object":
+            dtype[c] = info["dtype"]
+    settings = {"dtype": {**dtype, **caller_dtype}}
+    if parse_dates:
+        settings["parse_dates"] = parse_dates
+    # the pyarrow engine was only checked against the schema types when the registry was
+    # built, other read_csv arguments of the caller (e.g. index_col) use the C engine
+    if (schema.get("pyarrow") and set(kwargs) <= _PYARROW_KWARGS
+            and importlib.util.find_spec("pyarrow") is not None):
+        settings["engine"] = "pyarrow"
+    settings.update(kwargs)
+    return settings, [c for c in booleans if c not in caller_dtype]
+
+
+def _read_csv(source: Path, **kwargs) -> pd.DataFrame:
+    """
+    pd.read_csv, parsing the file again with the C engine if the pyarrow engine fails
+    """
+    if kwargs.get("engine") != "pyarrow":
+        return pd.read_csv(source, **kwargs)
+    try:
+        return pd.read_csv(source, **kwargs)
+    except Exception as e:
+        logging.debug(f"pyarrow engine failed for {source.name}, using the C engine: {e}")
+        kwargs.pop("engine")
+        return pd.read_csv(source, **kwargs)
+
+
+def load_data(fileName: str, columns=None, cache: bool = True, schema: bool = True,
+              compact: bool = False, **kwargs) -> pd.DataFrame:
+    """
+    Load a csv file from DATA_DIR
+    When the dataset is in the schema registry (SCHEMA_FILE in DATA_DIR, see
+    scripts/build_data_schemas.py) the column types are passed to pd.read_csv
+    instead of being inferred, and the pyarrow engine is used when it is installed.
+    Parameters:
+    ----------
+    fileName : str
+        name of the file, without the .csv extension
+    columns : list-like, optional
+        only read these columns
+    cache : bool, default True
+        reuse the result of an earlier load of the unchanged file with the same arguments
+    schema : bool, default True
+        use the schema registry
+    compact : bool, default False
+        read the columns with the compact types of `optimize_dtypes` from the schema:
+        narrow numeric types, categories, datetimes and booleans for yes/no columns
+    **kwargs
+        passed on to pd.read_csv, these take precedence over the schema
+    Return:
+    ------
+    DataFrame
+    """
+    if columns is not None:
+        kwargs["usecols"] = _get_list(columns)
+    source = _data_dir() / f"{fileName}.csv"
+    booleans = []
+    dataset_schema = _load_schemas().get(fileName) if schema else None
+    if dataset_schema is not None and not _schema_is_current(dataset_schema, source):
+        logging.debug(f"{source.name} changed since the schema registry was built, not using it")
+        dataset_schema = None
+    if dataset_schema is not None:
+        usecols = kwargs.get("usecols")
+        selected = usecols
+        if callable(usecols):
+            # the columns read_csv will keep
+            selected = [c for c in dataset_schema["columns"] if usecols(c)]
+        settings, booleans = _schema_kwargs(dataset_schema, selected, compact, dict(kwargs))
+        try:
+            df = _read_cached(source, _read_csv, cache, **settings)
+        except (ValueError, TypeError) as e:
+            # the file no longer fits the schema, e.g. missing values in an integer column
+            logging.debug(f"Unable to read {source.name} with its schema, reading without: {e}")
+            booleans = []
+            df = _read_cached(source, _read_csv, cache, **kwargs)
+    else:
+        df = _read_cached(source, _read_csv, cache, **kwargs)
+    if booleans:
+        convert_to_bool(df, booleans, inplace=True)
+    return df
+
+
+def load_excel(fileName: str, cache: bool = True, **kwargs) -> pd.DataFrame:
+    """
+    Load an Excel file from DATA_DIR, see `load_data`
+    """
+    return _read_cached(_data_dir() / f"{fileName}.xlsx", pd.read_excel, cache, **kwargs)
+
+
+def _numeric_block(df: pd.DataFrame, columns, dtype=None) -> np.ndarray:
+    """
+    The values of the columns as one 2-D float array (NA as NaN)
+    """
+    return df[columns].to_numpy(dtype=np.float64 if dtype is None else dtype, na_value=np.nan)
+
+
+def _scale_columns(df: pd.DataFrame, columns, suffix, offset, scale, drop_old=False,
+                   inplace=False, dtype=None, block=None):
+    """
+    Add `{column}{suffix}` columns with (column - offset) / scale, computed as one block
+    Parameters:
+    ----------
+    offset, scale : array-like
+        one value for each column
+    block : ndarray, optional
+        the values of the columns, if they were already extracted
+    Return:
+    ------
+    The modified dataframe, or None when inplace
+    """
+    if block is None:
+        block = _numeric_block(df, columns, dtype)
+    scaled = (block - np.asarray(offset, dtype=block.dtype)) / np.asarray(scale, dtype=block.dtype)
+    if inplace:
+        data = df
+    else:
+        # the result never shares data with df, columns that are dropped are not copied
+        data = df.drop(columns=columns) if drop_old else df.copy()
+    for i, c in enumerate(columns):
+        data[f"{c}{suffix}"] = scaled[:, i]
+    if drop_old and inplace:
+        data.drop(columns=columns, inplace=True)
+    return None if inplace else data
+
+
+def normalize(df:pd.DataFrame, columns, drop_old=False, inplace=False, dtype=None)-> pd.DataFrame:
+    """
+    Add min-max normalized copies of the columns, named `{column}_NORM`
+    Parameters:
+    ----------
+    df : DataFrame
+        the DataFrame to work on
+    columns : str or list-like
+        the numeric columns to normalize
+    drop_old : bool, default False
+        remove the original columns
+    inplace : bool, default False
+        if True, then add the columns to the dataset provided and return None
+    dtype : numpy dtype, default float64
+        dtype of the new columns, e.g. np.float32 to halve the memory used
+    Return:
+    ------
+    The modified dataframe
+    """
+    columns = _get_list(columns)
+    block = _numeric_block(df, columns, dtype)
+    low, high = np.nanmin(block, axis=0), np.nanmax(block, axis=0)
+    return _scale_columns(df, columns, "_NORM", low, high - low, drop_old, inplace, dtype, block)
+
+
+def standardize(df:pd.DataFrame, columns, drop_old=False, inplace=False, dtype=None)-> pd.DataFrame:
+    """
+    Add standardized (z-score) copies of the columns, named `{column}_STD`
+    The parameters are the same as for `normalize`.
+    """
+    columns = _get_list(columns)
+    block = _numeric_block(df, columns, dtype)
+    mean, std = np.nanmean(block, axis=0), np.nanstd(block, axis=0, ddof=1)
+    return _scale_columns(df, columns, "_STD", mean, std, drop_old, inplace, dtype, block)
+
+
+class _ColumnScaler:
+    """
+    Base class for the scalers: statistics are computed with `fit` and reused by `transform`
+    """
+    suffix = ""
+    _stats = ()
+
+    def __init__(self, columns, dtype=None):
+        self.columns = _get_list(columns)
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the statistics computed so far
+        """
+        for name in self._stats:
+            setattr(self, name, None)
+        return self
+
+    @property
+    def is_fitted(self):
+        return all(getattr(self, name) is not None for name in self._stats)
+
+    def partial_fit(self, df: pd.DataFrame):
+        """
+        Update the statistics with another chunk of data
+        """
+        self._partial_fit_block(_numeric_block(df, self.columns))
+        return self
+
+    def fit(self, data):
+        """
+        Compute the statistics of the columns
+        Parameters:
+        ----------
+        data : DataFrame or iterable of DataFrames
+            the training data, or chunks of it, e.g. pd.read_csv(..., chunksize=100_000)
+        Return:
+        ------
+        The scaler
+        """
+        self.reset()
+        chunks = [data] if isinstance(data, pd.DataFrame) else data
+        for chunk in chunks:
+            self.partial_fit(chunk)
+        return self
+
+    def transform(self, df: pd.DataFrame, drop_old=False, inplace=False) -> pd.DataFrame:
+        """
+        Add the scaled columns, named `{column}{suffix}`, using the fitted statistics
+        Parameters:
+        ----------
+        df : DataFrame
+            the DataFrame to work on, e.g. the test data or a new batch to score
+        drop_old : bool, default False
+            remove the original columns
+        inplace : bool, default False
+            if True, then add the columns to the dataset provided and return None
+        Return:
+        ------
+        The modified dataframe
+        """
+        if not self.is_fitted:
+            raise ValueError(f"{type(self).__name__} needs to be fitted before transform")
+        offset, scale = self._offset_scale()
+        return _scale_columns(df, self.columns, self.suffix, offset, scale,
+                              drop_old, inplace, self.dtype)
+
+    def fit_transform(self, df: pd.DataFrame, drop_old=False, inplace=False) -> pd.DataFrame:
+        """
+        Fit on the data and transform it
+        """
+        return self.fit(df).transform(df, drop_old=drop_old, inplace=inplace)
+
+    def to_dict(self) -> dict:
+        """
+        The settings and statistics as a json serializable dict
+        """
+        settings = {
+            "columns": self.columns,
+            "dtype": None if self.dtype is None else np.dtype(self.dtype).name,
+        }
+        for name in self._stats:
+            value = getattr(self, name)
+            settings[name] = None if value is None else value.tolist()
+        return settings
+
+    @classmethod
+    def from_dict(cls, settings: dict):
+        """
+        Create a scaler from the result of `to_dict`
+        """
+        scaler = cls(settings["columns"], dtype=settings["dtype"])
+        for name in cls._stats:
+            value = settings[name]
+            setattr(scaler, name, None if value is None else np.asarray(value, dtype=np.float64))
+        return scaler
+
+
+class ColumnNormalizer(_ColumnScaler):
+    """
+    Min-max normalize columns with statistics computed once, see `normalize`
+    
+    Parameters:
+    ----------
+    columns : str or list-like
+        the numeric columns to normalize
+    dtype : numpy dtype, default float64
+        dtype of the new columns
+    Example:
+    -------
+    scaler = ColumnNormalizer(["Income", "CCAvg"]).fit(train_df)
+    train_df = scaler.transform(train_df)
+    test_df = scaler.transform(test_df)
+    """
+    suffix = "_NORM"
+    _stats = ("min_", "max_")
+
+    def _partial_fit_block(self, block):
+        with np.errstate(invalid="ignore"), warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)
+            low, high = np.nanmin(block, axis=0), np.nanmax(block, axis=0)
+        if self.min_ is not None:
+            low, high = np.fmin(self.min_, low), np.fmax(self.max_, high)
+        self.min_, self.max_ = low, high
+
+    def _offset_scale(self):
+        return self.min_, self.max_ - self.min_
+
+
+class ColumnStandardizer(_ColumnScaler):
+    """
+    Standardize columns (z-score) with statistics computed once, see `standardize`
+    
+    The mean and standard deviation are combined over chunks, so they can be computed
+    in a single pass over data that doesn't fit in memory.
+    The parameters are the same as for `ColumnNormalizer`.
+    """
+    suffix = "_STD"
+    _stats = ("count_", "mean_", "m2_")
+
+    def _partial_fit_block(self, block):
+        count = np.sum(~np.isnan(block), axis=0).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = np.where(count > 0, np.nansum(block, axis=0) / count, 0.0)
+        m2 = np.nansum((block - mean) ** 2, axis=0)
+        if self.count_ is None:
+            self.count_, self.mean_, self.m2_ = count, mean, m2
+            return
+        # combine the running statistics with the chunk (Chan et al.)
+        total = self.count_ + count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(total > 0, count / total, 0.0)
+        delta = mean - self.mean_
+        self.m2_ = self.m2_ + m2 + delta ** 2 * self.count_ * weight
+        self.mean_ = self.mean_ + delta * weight
+        self.count_ = total
+
+    def _offset_scale(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.mean_, np.sqrt(self.m2_ / (self.count_ - 1))
+
+
+class CleaningPipeline:
+    """
+    Chain cleaning functions and apply them to a DataFrame or, chunk by chunk, to a csv file
+
+    Each step is a function that takes a DataFrame as its first argument and returns the
+    cleaned DataFrame, such as the functions in this module. When reading in chunks, the
+    steps should only depend on the rows in the chunk (e.g. `remove_duplicates` only removes
+    duplicates within a chunk).
+    The categories of `convert_to_categorical` and `convert_to_ordinal` steps would differ
+    between chunks, so when streaming the categories are collected first with `fit` (a pass
+    over the file that only keeps the distinct values) and then used for every chunk.
+
+    Example:
+    -------
+    pipeline = (CleaningPipeline()
+                .add(remove_columns, ["ID", "ZIP Code"])
+                .add(replace_string_in_col_name, find_val=" ", replace_val="_")
+                .add(convert_to_bool, ["Online", "CreditCard"])
+                .add(convert_to_categorical, "Education"))
+    pipeline.run(DATA_DIR / "UniversalBank.csv", "UniversalBank_clean.csv", chunksize=100_000)
+    """
+
+    def __init__(self):
+        self.steps = []
+        self.categories = None
+
+    def add(self, func, *args, **kwargs):
+        """
+        Add a step to the pipeline, the arguments are passed to `func` after the DataFrame
+        Return:
+        ------
+        The pipeline, so calls can be chained
+        """
+        self.steps.append((func, args, kwargs))
+        self.categories = None
+        return self
+
+    def _is_categorical(self, func):
+        return func is convert_to_categorical or func is convert_to_ordinal
+
+    def _step_columns(self, df, args, kwargs):
+        return _get_column_list(df, kwargs.get("columns", args[0] if args else None))
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Run all steps on a DataFrame, using the categories collected by `fit` if available
+        """
+        for func, args, kwargs in self.steps:
+            if self._is_categorical(func) and self.categories is not None:
+                ordered = func is convert_to_ordinal
+                for col in self._step_columns(df, args, kwargs):
+                    df[col] = pd.Categorical(
+                        df[col], categories=self.categories[col], ordered=ordered
+                    )
+            else:
+                df = func(df, *args, **kwargs)
+        return df
+
+    def fit(self, source, chunksize: int = 100_000, **kwargs):
+        """
+        Collect the categories of the categorical steps over all chunks of a csv file
+        Parameters:
+        ----------
+        source : str or Path
+            the csv file to read
+        chunksize : int, default 100,000
+            number of rows read at a time
+        **kwargs
+            passed on to pd.read_csv
+        Return:
+        ------
+        The pipeline
+        """
+        last = max(
+            (i for i, (func, _, _) in enumerate(self.steps) if self._is_categorical(func)),
+            default=-1,
+        )
+        values = {}
+        for chunk in pd.read_csv(source, chunksize=chunksize, **kwargs):
+            # only the steps up to the last categorical conversion are needed
+            for func, args, kwargs_step in self.steps[: last + 1]:
+                if self._is_categorical(func):
+                    for col in self._step_columns(chunk, args, kwargs_step):
+                        values.setdefault(col, set()).update(chunk[col].dropna().unique())
+                else:
+                    chunk = func(chunk, *args, **kwargs_step)
+        self.categories = {}
+        for col, col_values in values.items():
+            try:
+                self.categories[col] = sorted(col_values)
+            except TypeError:
+                self.categories[col] = list(col_values)
+        return self
+
+    def iter_chunks(self, source, chunksize: int = 100_000, **kwargs):
+        """
+        Read a csv file in chunks and yield the cleaned chunks
+        The parameters are the same as for `fit`.
+        """
+        if self.categories is None:
+            self.fit(source, chunksize=chunksize, **kwargs)
+        for chunk in pd.read_csv(source, chunksize=chunksize, **kwargs):
+            yield self.apply(chunk)
 
+    def run(self, source, destination, chunksize: int = 100_000, index: bool = False, **kwargs) -> int:
+        """
+        Clean a csv file chunk by chunk and write the result to another csv file
+        Parameters:
+        ----------
+        source : str or Path
+            the csv file to read
+        destination : str or Path
+            the csv file to write, it is replaced if it exists
+        chunksize : int, default 100,000
+            number of rows read at a time
+        index : bool, default False
+            write the index of the chunks
+        **kwargs
+            passed on to pd.read_csv
+        Return:
+        ------
+        int
+            the number of rows written
+        """
+        rows = 0
+        for chunk in self.iter_chunks(source, chunksize=chunksize, **kwargs):
+            chunk.to_csv(destination, mode="w" if rows == 0 else "a", header=rows == 0, index=index)
+            rows += len(chunk)
+        return rows
 
-def standardize(df:pd.DataFrame, columns, drop_old=False)-> pd.DataFrame:
-    data = df.copy(deep=True)
-    for c in columns:
-        new_column_name = f"{c}_STD"
-        data[new_column_name] = (data[c] - data[c].mean()) / data[c].std()
-    if drop_old:
-        data.drop(columns=columns,inplace=True)
-    return data
 
 if __name__ == "__main__":
     test_df = pd.DataFrame({'a':[1,0,1,0]})
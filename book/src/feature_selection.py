@@ -3,20 +3,32 @@ Utility functions for "Data Mining for Business Analytics: Concepts, Techniques,
 Applications in Python"
 (c) 2019 Galit Shmueli, Peter C. Bruce, Peter Gedeck
 '''
+import hashlib
 import itertools
+import json
+import os
+import shelve
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from pathlib import Path
 import numpy as np  
 import pandas as pd  
-from sklearn.compose import ColumnTransformer
-from sklearn.pipeline import Pipeline
-from sklearn.utils.validation import check_is_fitted
-import plotly.express as px
+# sklearn, scipy and plotly are imported where they are used, to keep the import of this module fast
 
-def exhaustive_search(variables, train_model, score_model):
+try:
+    from .metric import _aic_from_sse, _bic_from_sse, _adjusted_r2_from_sse
+except ImportError:
+    from metric import _aic_from_sse, _bic_from_sse, _adjusted_r2_from_sse
+
+def exhaustive_search(variables, train_model, score_model, cache=None):
     """ Variable selection using backward elimination
     Input:
         variables: complete list of variables to consider in model building
         train_model: function that returns a fitted model for a given set of variables
         score_model: function that returns the score of a model; better models have lower scores
+        cache (optional): SelectionCache shared with other selection runs on the same data
     Returns:
         List of best subset models for increasing number of variables
     """
@@ -28,8 +40,9 @@ def exhaustive_search(variables, train_model, score_model):
         best_model = None
         for subset in itertools.combinations(variables, nvariables):
             subset = list(subset)
-            subset_model = train_model(subset)
-            subset_score = score_model(subset_model, subset)
+            # one subset at a time, so only the best models are kept in memory
+            [(subset_score, subset_model)] = _evaluate_candidates([subset], train_model, score_model,
+                                                                  cache=cache)
             if best_subset is None or best_score > subset_score:
                 best_subset = subset
                 best_score = subset_score
@@ -43,92 +56,449 @@ def exhaustive_search(variables, train_model, score_model):
     return result
 
 
-def backward_elimination(variables, train_model, score_model, verbose=False):
+class _LinearGram:
+    """ Cross-products of the centered predictors and outcome of a linear regression.
+
+    X'X, X'y and y'y are computed once; the residual sum of squares (RSS) of any
+    subset of the predictors is then obtained from the Gram matrix alone, without
+    touching the data again. Centering takes care of the intercept.
+    """
+    def __init__(self, X, y, variables=None):
+        X = pd.DataFrame(X)
+        self.variables = list(X.columns) if variables is None else list(variables)
+        data = X[self.variables].to_numpy(dtype=float)
+        y = np.asarray(y, dtype=float).ravel()
+        if len(y) != len(data):
+            raise ValueError('X and y need to have the same number of rows')
+        self.n = len(y)
+        data = data - data.mean(axis=0)
+        y = y - y.mean()
+        self.xtx = data.T @ data
+        self.xty = data.T @ y
+        self.sst = float(y @ y)
+
+    def inverse(self, subset):
+        """ Return (inverse of X'X, coefficients, RSS) for the list of column indices """
+        if len(subset) == 0:
+            return np.empty((0, 0)), np.empty(0), self.sst
+        gram = self.xtx[np.ix_(subset, subset)]
+        try:
+            gram_inv = np.linalg.inv(gram)
+        except np.linalg.LinAlgError:
+            raise ValueError('The predictors are linearly dependent') from None
+        beta = gram_inv @ self.xty[subset]
+        return gram_inv, beta, self.sst - float(self.xty[subset] @ beta)
+
+    @staticmethod
+    def drop_rss(gram_inv, beta, rss):
+        """ RSS after removing each of the variables in turn """
+        return rss + beta ** 2 / np.diag(gram_inv)
+
+    @staticmethod
+    def drop(gram_inv, beta, position):
+        """ Rank-one downdate of the inverse and coefficients after removing a variable """
+        keep = np.arange(len(beta)) != position
+        column = gram_inv[keep, position]
+        pivot = gram_inv[position, position]
+        gram_inv = gram_inv[np.ix_(keep, keep)] - np.outer(column, column) / pivot
+        beta = beta[keep] - column * (beta[position] / pivot)
+        return gram_inv, beta
+
+    def add_rss(self, subset, gram_inv, beta, rss, candidates):
+        """ RSS after adding each of the candidate variables in turn """
+        cross = self.xtx[np.ix_(subset, candidates)]
+        proj = gram_inv @ cross
+        # Schur complement of the new column and its correlation with the residual
+        pivot = self.xtx[candidates, candidates] - np.sum(cross * proj, axis=0)
+        resid = self.xty[candidates] - cross.T @ beta
+        degenerate = pivot <= 1e-10 * self.xtx[candidates, candidates]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(degenerate, rss, rss - resid ** 2 / pivot)
+
+    def add(self, subset, gram_inv, beta, candidate):
+        """ Rank-one update of the inverse and coefficients after appending a variable """
+        cross = self.xtx[subset, candidate]
+        proj = gram_inv @ cross
+        pivot = self.xtx[candidate, candidate] - cross @ proj
+        resid = self.xty[candidate] - cross @ beta
+        size = len(subset)
+        updated = np.empty((size + 1, size + 1))
+        updated[:size, :size] = gram_inv + np.outer(proj, proj) / pivot
+        updated[:size, size] = updated[size, :size] = -proj / pivot
+        updated[size, size] = 1 / pivot
+        beta = np.append(beta - proj * (resid / pivot), resid / pivot)
+        return updated, beta
+
+    def score(self, rss, nvariables, criterion):
+        """ Score subsets on the training data; lower scores are better """
+        if criterion == 'AIC':
+            return _aic_from_sse(rss, self.n, np.asarray(nvariables) + 1)
+        if criterion == 'BIC':
+            return _bic_from_sse(rss, self.n, np.asarray(nvariables) + 1)
+        if criterion == 'adjusted_r2':
+            # negated so that lower scores are better
+            return -_adjusted_r2_from_sse(rss, self.sst, self.n, nvariables)
+        if criterion == 'rss':
+            return rss
+        raise ValueError(f'Unknown criterion {criterion}, use one of AIC, BIC, adjusted_r2 or rss')
+
+
+def linear_exhaustive_search(X, y, variables=None, criterion='AIC', verbose=False):
+    """ Best subset selection for linear regression using branch and bound
+    Input:
+        X: DataFrame with the candidate predictors
+        y: outcome variable
+        variables (optional): list of columns of X to consider, default all columns
+        criterion: score of the models, one of 'AIC', 'BIC', 'adjusted_r2' (negated) or 'rss'
+        verbose: print the number of subsets that were evaluated
+    Returns:
+        List of best subset models for increasing number of variables in the same
+        format as exhaustive_search; the scores are computed on the training data
+    Notes:
+        X'X and X'y are computed once. The search walks the tree of subsets obtained by
+        dropping one variable at a time ("leaps and bounds"), updating the inverse of the
+        Gram matrix with rank-one downdates instead of refitting. A branch is skipped when
+        the RSS of its largest subset can't beat the best subsets found so far, as removing
+        variables never reduces the RSS. For a given number of variables all criteria rank
+        subsets by their RSS, so only the winning models are fitted with LinearRegression.
+    """
+    X = pd.DataFrame(X)
+    gram = _LinearGram(X, y, variables)
+    variables = gram.variables
+    nvariables = len(variables)
+    best_rss = np.full(nvariables + 1, np.inf)
+    best_subset = [None] * (nvariables + 1)
+    nevaluated = 0
+
+    def search(subset, fixed, gram_inv, beta, rss):
+        # descendants of this node keep subset[:fixed] and drop any of subset[fixed:]
+        nonlocal nevaluated
+        drop_rss = gram.drop_rss(gram_inv, beta, rss)
+        # try the most important variables first, their subtrees are the most likely to be pruned
+        order = fixed + np.argsort(-drop_rss[fixed:], kind='stable')
+        order = np.concatenate([np.arange(fixed), order])
+        subset = [subset[i] for i in order]
+        gram_inv = gram_inv[np.ix_(order, order)]
+        beta, drop_rss = beta[order], drop_rss[order]
+
+        size = len(subset) - 1
+        nevaluated += len(subset) - fixed
+        for position in range(fixed, len(subset)):
+            if drop_rss[position] < best_rss[size]:
+                best_rss[size] = drop_rss[position]
+                best_subset[size] = subset[:position] + subset[position + 1:]
+        # visit small subtrees first to tighten the bounds quickly
+        for position in reversed(range(fixed, len(subset))):
+            # subsets below the child have between `position` and `size - 1` variables
+            bounds = best_rss[max(position, 1):size]
+            if len(bounds) == 0 or drop_rss[position] >= bounds.max():
+                continue
+            child_inv, child_beta = gram.drop(gram_inv, beta, position)
+            search(subset[:position] + subset[position + 1:], position,
+                   child_inv, child_beta, drop_rss[position])
+
+    full_subset = list(range(nvariables))
+    gram_inv, beta, rss = gram.inverse(full_subset)
+    best_rss[nvariables], best_subset[nvariables] = rss, full_subset
+    nevaluated += 1
+    if nvariables > 1:
+        search(full_subset, 0, gram_inv, beta, rss)
+    if verbose:
+        print(f'Evaluated {nevaluated} of {2 ** nvariables - 1} subsets')
+
+    from sklearn.linear_model import LinearRegression
+
+    result = []
+    for size in range(1, nvariables + 1):
+        subset_variables = [variables[i] for i in sorted(best_subset[size])]
+        model = LinearRegression()
+        model.fit(X[subset_variables], y)
+        result.append({
+            'n': size,
+            'variables': subset_variables,
+            'score': float(gram.score(best_rss[size], size, criterion)),
+            'model': model,
+        })
+    return result
+
+
+def _fit_and_score(train_model, score_model, variables):
+    """ Train and score the model for one set of variables; returns (score, model) """
+    model = train_model(variables)
+    return score_model(model, variables), model
+
+
+@contextmanager
+def _selection_executor(n_jobs=None, executor=None):
+    """ Provide the executor used to evaluate the candidates of a selection step
+    Input:
+        n_jobs: number of worker threads; None or 1 evaluates serially, -1 uses all cores
+        executor: a concurrent.futures.Executor, takes precedence over n_jobs and is
+            left open for the caller to shut down
+    """
+    if executor is not None:
+        yield executor
+    elif n_jobs is None or n_jobs == 1:
+        yield None
+    else:
+        max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            yield pool
+
+
+def data_fingerprint(*data):
+    """ Fingerprint of the data used to train models, to key a persisted SelectionCache
+    Input:
+        data: DataFrames, Series or arrays (e.g. X_train, y_train)
+    Returns:
+        hex digest that changes whenever the values, index or column names change
+    """
+    digest = hashlib.sha1()
+    for item in data:
+        if isinstance(item, (pd.DataFrame, pd.Series)):
+            labels = item.columns if isinstance(item, pd.DataFrame) else item.name
+            digest.update(repr(labels).encode())
+            digest.update(pd.util.hash_pandas_object(item, index=True).to_numpy().tobytes())
+        else:
+            item = np.ascontiguousarray(item)
+            digest.update(f'{item.dtype}{item.shape}'.encode())
+            digest.update(item.tobytes())
+    return digest.hexdigest()
+
+
+class SelectionCache:
+    """ Memoize fitted models and their scores by the set of variables in the model.
+
+    Pass the same instance as `cache` to exhaustive or stepwise selection runs that use the same
+    train_model and score_model, so subsets that were already fitted are not fitted again. A model
+    is only reused for the variables in the order it was fitted with, so predicting with the
+    returned variables works; the same set in another order is fitted again. Only `maxsize`
+    models are kept in memory, the least recently used ones are evicted first.
+    If `path` is given the entries are also written to a shelve file in that directory, named
+    after `fingerprint` (see `data_fingerprint`) and `namespace`, so later runs on the same data
+    with the same train_model and score_model can reuse them. The models need to be picklable for this.
+
+    Parameters
+    ----------
+    maxsize : maximum number of fitted models kept in memory, default 128. None for no limit.
+    path : directory for the persisted cache, default None (memory only)
+    fingerprint : identifies the data the models were trained on; required with path
+    namespace : identifies train_model and score_model (e.g. 'linear-AIC'); required with path,
+        runs with another model or score use another file
+
+    Attributes
+    __________
+    hits : number of lookups served from the cache
+    misses : number of lookups that required fitting the model
+    """
+    def __init__(self, maxsize=128, path=None, fingerprint=None, namespace=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._store = None
+        if path is not None:
+            if fingerprint is None:
+                raise ValueError('A fingerprint of the data is required to persist the cache')
+            if namespace is None:
+                raise ValueError('A namespace for the model and score is required to persist the cache')
+            # hashed, so any namespace gives a valid file name
+            scope = hashlib.sha1(str(namespace).encode()).hexdigest()[:12]
+            Path(path).mkdir(parents=True, exist_ok=True)
+            self._store = shelve.open(str(Path(path) / f'selection-{fingerprint}-{scope}'))
+
+    @staticmethod
+    def _key(variables):
+        return frozenset(variables)
+
+    @staticmethod
+    def _store_key(key):
+        return json.dumps(sorted(str(v) for v in key))
+
+    def get(self, variables):
+        """ Return (score, model) for the variables or None if they weren't fitted before
+        in this order """
+        key = self._key(variables)
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+        elif self._store is not None and self._store_key(key) in self._store:
+            entry = self._store[self._store_key(key)]
+            self._remember(key, entry)
+        # (score, model, variables in the order the model was fitted with)
+        if entry is not None and len(entry) == 3 and entry[2] == list(variables):
+            self.hits += 1
+            return entry[:2]
+        self.misses += 1
+        return None
+
+    def put(self, variables, score, model):
+        """ Add the score and fitted model for the variables """
+        key = self._key(variables)
+        entry = (score, model, list(variables))
+        self._remember(key, entry)
+        if self._store is not None:
+            self._store[self._store_key(key)] = entry
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        if self.maxsize is not None:
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Remove all entries from memory and from the persisted cache """
+        self._entries.clear()
+        if self._store is not None:
+            self._store.clear()
+
+    def close(self):
+        """ Write the persisted cache to disk and close it """
+        if self._store is not None:
+            self._store.close()
+            self._store = None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _evaluate_candidates(candidates, train_model, score_model, executor=None, cache=None):
+    """ Train and score a model for each list of variables in candidates
+    Input:
+        candidates: list of variable lists
+        executor (optional): executor to fan out the fits
+        cache (optional): SelectionCache with previously fitted models
+    Returns:
+        List of (score, model) in the order of candidates
+    """
+    results = [None] * len(candidates)
+    if cache is not None:
+        results = [cache.get(candidate) for candidate in candidates]
+    missing = [i for i, result in enumerate(results) if result is None]
+
+    evaluate = partial(_fit_and_score, train_model, score_model)
+    if executor is None:
+        evaluated = [evaluate(candidates[i]) for i in missing]
+    else:
+        # map returns the results in the order of the candidates, keeping the tie-breaking
+        # of the sort in the selection functions identical to the serial path
+        evaluated = executor.map(evaluate, [candidates[i] for i in missing])
+    for i, (score, model) in zip(missing, evaluated):
+        results[i] = (score, model)
+        if cache is not None:
+            cache.put(candidates[i], score, model)
+    return results
+
+
+def backward_elimination(variables, train_model, score_model, verbose=False,
+                         n_jobs=None, executor=None, cache=None):
     """ Variable selection using backward elimination
     Input:
         variables: complete list of variables to consider in model building
         train_model: function that returns a fitted model for a given set of variables
         score_model: function that returns the score of a model; better models have lower scores
+        n_jobs (optional): number of threads used to fit the candidates of a step, -1 for all cores
+        executor (optional): concurrent.futures.Executor used instead of n_jobs; use a
+            ProcessPoolExecutor if train_model and score_model can be pickled
+        cache (optional): SelectionCache to reuse models fitted for the same set of variables
     Returns:
         (best_model, best_variables)
     """
     # we start with a model that contains all variables
     best_variables = list(variables)
-    best_model = train_model(best_variables)
-    best_score = score_model(best_model, best_variables)
+    best_score, best_model = _evaluate_candidates(
+        [best_variables], train_model, score_model, cache=cache)[0]
     if verbose:
         print('Variables: ' + ', '.join(variables))
         print(f'Start: score={best_score:.2f}')
 
-    while len(best_variables) > 1:
-        step = [(best_score, None, best_model)]
-        for removeVar in best_variables:
-            step_var = list(best_variables)
-            step_var.remove(removeVar)
-            step_model = train_model(step_var)
-            step_score = score_model(step_model, step_var)
-            step.append((step_score, removeVar, step_model))
-
-        # sort by ascending score
-        step.sort(key=lambda x: x[0])
-
-        # the first entry is the model with the lowest score
-        best_score, removed_step, best_model = step[0]
-        if verbose:
-            print(f'Step: score={best_score:.2f}, remove {removed_step}')
-        if removed_step is None:
-            # step here, as removing more variables is detrimental to performance
-            break
-        best_variables.remove(removed_step)
+    with _selection_executor(n_jobs, executor) as pool:
+        while len(best_variables) > 1:
+            step = [(best_score, None, best_model)]
+            candidates = []
+            for removeVar in best_variables:
+                step_var = list(best_variables)
+                step_var.remove(removeVar)
+                candidates.append(step_var)
+            evaluated = _evaluate_candidates(candidates, train_model, score_model, pool, cache)
+            for removeVar, (step_score, step_model) in zip(best_variables, evaluated):
+                step.append((step_score, removeVar, step_model))
+
+            # sort by ascending score
+            step.sort(key=lambda x: x[0])
+
+            # the first entry is the model with the lowest score
+            best_score, removed_step, best_model = step[0]
+            if verbose:
+                print(f'Step: score={best_score:.2f}, remove {removed_step}')
+            if removed_step is None:
+                # step here, as removing more variables is detrimental to performance
+                break
+            best_variables.remove(removed_step)
     return best_model, best_variables
 
 
-def forward_selection(variables, train_model, score_model, verbose=True):
+def forward_selection(variables, train_model, score_model, verbose=True,
+                      n_jobs=None, executor=None, cache=None):
     """ Variable selection using forward selection
     Input:
         variables: complete list of variables to consider in model building
         train_model: function that returns a fitted model for a given set of variables
         score_model: function that returns the score of a model; better models have lower scores
+        n_jobs (optional): number of threads used to fit the candidates of a step, -1 for all cores
+        executor (optional): concurrent.futures.Executor used instead of n_jobs; use a
+            ProcessPoolExecutor if train_model and score_model can be pickled
+        cache (optional): SelectionCache to reuse models fitted for the same set of variables
     Returns:
         (best_model, best_variables)
     """
     # we start with a model that contains no variables
     best_variables = []
-    best_model = train_model(best_variables)
-    best_score = score_model(best_model, best_variables)
+    best_score, best_model = _evaluate_candidates(
+        [best_variables], train_model, score_model, cache=cache)[0]
     if verbose:
         print('Variables: ' + ', '.join(variables))
         print(f'Start: score={best_score:.2f}, constant')
-    while True:
-        step = [(best_score, None, best_model)]
-        for addVar in variables:
-            if addVar in best_variables:
-                continue
-            step_var = list(best_variables)
-            step_var.append(addVar)
-            step_model = train_model(step_var)
-            step_score = score_model(step_model, step_var)
-            step.append((step_score, addVar, step_model))
-        step.sort(key=lambda x: x[0])
-
-        # the first entry in step is now the model that improved most
-        best_score, added_step, best_model = step[0]
-        if verbose:
-            print(f'Step: score={best_score:.2f}, add {added_step}')
-        if added_step is None:
-            # stop here, as adding more variables is detrimental to performance
-            break
-        best_variables.append(added_step)
+    with _selection_executor(n_jobs, executor) as pool:
+        while True:
+            step = [(best_score, None, best_model)]
+            added, candidates = [], []
+            for addVar in variables:
+                if addVar in best_variables:
+                    continue
+                step_var = list(best_variables)
+                step_var.append(addVar)
+                added.append(addVar)
+                candidates.append(step_var)
+            evaluated = _evaluate_candidates(candidates, train_model, score_model, pool, cache)
+            for addVar, (step_score, step_model) in zip(added, evaluated):
+                step.append((step_score, addVar, step_model))
+            step.sort(key=lambda x: x[0])
+
+            # the first entry in step is now the model that improved most
+            best_score, added_step, best_model = step[0]
+            if verbose:
+                print(f'Step: score={best_score:.2f}, add {added_step}')
+            if added_step is None:
+                # stop here, as adding more variables is detrimental to performance
+                break
+            best_variables.append(added_step)
     return best_model, best_variables
 
 
-def stepwise_selection(variables, train_model, score_model, direction='both', verbose=True):
+def stepwise_selection(variables, train_model, score_model, direction='both', verbose=True,
+                       n_jobs=None, executor=None, cache=None):
     """ Variable selection using forward and/or backward selection
     Input:
         variables: complete list of variables to consider in model building
         train_model: function that returns a fitted model for a given set of variables
         score_model: function that returns the score of a model; better models have lower scores
         direction: use it to limit stepwise selection to either 'forward' or 'backward'
+        n_jobs (optional): number of threads used to fit the candidates of a step, -1 for all cores
+        executor (optional): concurrent.futures.Executor used instead of n_jobs; use a
+            ProcessPoolExecutor if train_model and score_model can be pickled
+        cache (optional): SelectionCache to reuse models fitted for the same set of variables
     Returns:
         (best_model, best_variables)
     """
@@ -142,49 +512,236 @@ def stepwise_selection(variables, train_model, score_model, direction='both', ve
 
     # we start with a model that contains no variables
     best_variables = [] if 'forward' in directions else list(variables)
-    best_model = train_model(best_variables)
-    best_score = score_model(best_model, best_variables)
+    best_score, best_model = _evaluate_candidates(
+        [best_variables], train_model, score_model, cache=cache)[0]
     if verbose:
         print('Variables: ' + ', '.join(variables))
         print(f'Start: score={best_score:.2f}, constant')
 
-    while True:
-        step = [(best_score, None, best_model, 'unchanged')]
-        if FORWARD in directions:
-            for variable in variables:
-                if variable in best_variables:
-                    continue
-                step_var = list(best_variables)
-                step_var.append(variable)
-                step_model = train_model(step_var)
-                step_score = score_model(step_model, step_var)
-                step.append((step_score, variable, step_model, 'add'))
+    with _selection_executor(n_jobs, executor) as pool:
+        while True:
+            step = [(best_score, None, best_model, 'unchanged')]
+            moves, candidates = [], []
+            if FORWARD in directions:
+                for variable in variables:
+                    if variable in best_variables:
+                        continue
+                    step_var = list(best_variables)
+                    step_var.append(variable)
+                    moves.append((variable, 'add'))
+                    candidates.append(step_var)
 
-        if 'backward' in directions:
-            for variable in best_variables:
-                step_var = list(best_variables)
-                step_var.remove(variable)
-                step_model = train_model(step_var)
-                step_score = score_model(step_model, step_var)
-                step.append((step_score, variable, step_model, 'remove'))
-
-        # sort by ascending score
-        step.sort(key=lambda x: x[0])
-
-        # the first entry is the model with the lowest score
-        best_score, chosen_variable, best_model, direction = step[0]
-        if verbose:
-            print(f'Step: score={best_score:.2f}, {direction} {chosen_variable}')
-        if chosen_variable is None:
-            # step here, as adding or removing more variables is detrimental to performance
-            break
-        if direction == 'add':
-            best_variables.append(chosen_variable)
-        else:
-            best_variables.remove(chosen_variable)
+            if 'backward' in directions:
+                for variable in best_variables:
+                    step_var = list(best_variables)
+                    step_var.remove(variable)
+                    moves.append((variable, 'remove'))
+                    candidates.append(step_var)
+
+            evaluated = _evaluate_candidates(candidates, train_model, score_model, pool, cache)
+            for (variable, move), (step_score, step_model) in zip(moves, evaluated):
+                step.append((step_score, variable, step_model, move))
+
+            # sort by ascending score
+            step.sort(key=lambda x: x[0])
+
+            # the first entry is the model with the lowest score
+            best_score, chosen_variable, best_model, direction = step[0]
+            if verbose:
+                print(f'Step: score={best_score:.2f}, {direction} {chosen_variable}')
+            if chosen_variable is None:
+                # step here, as adding or removing more variables is detrimental to performance
+                break
+            if direction == 'add':
+                best_variables.append(chosen_variable)
+            else:
+                best_variables.remove(chosen_variable)
     return best_model, best_variables
 
 
+class LinearStepwiseSelector:
+    """
+    Stepwise selection for linear regression using rank-one updates.
+
+    Follows the same path as `stepwise_selection` with a LinearRegression model scored on the
+    training data, but never refits a model while searching. X'X and X'y are computed once and
+    the residual sum of squares (RSS) of every candidate that adds or removes a variable is
+    derived from the inverse of the Gram matrix of the current model. The scores use the same
+    formulas as `metric.AIC_score`, `metric.BIC_score` and `metric.adjusted_r2_score`.
+
+    Parameters
+    ----------
+    X : a DataFrame with the candidate predictors
+    y : the outcome variable
+    criterion : 'AIC' (default), 'BIC', 'adjusted_r2' (negated, so lower is better) or 'rss'
+    direction : 'both' (default), 'forward' or 'backward'
+    verbose : a boolean. Whether to print the steps. Default is True.
+
+    Attributes
+    __________
+    best_variables_ : the list of selected variables
+    best_score_ : the score of the selected model
+    best_model_ : a LinearRegression fitted on the selected variables, None for the constant model
+    history_ : a list of (score, variable, direction) for each step taken
+    """
+    def __init__(self, X, y, criterion='AIC', direction='both', verbose=True):
+        self.X = pd.DataFrame(X)
+        self.y = y
+        self.criterion = criterion
+        self.direction = direction
+        self.verbose = verbose
+
+    def select(self, variables=None):
+        """
+        Run the stepwise selection
+        Parameters
+        ----------
+        variables : complete list of variables to consider in model building, default all columns of X
+        Returns
+        -------
+        (best_model, best_variables)
+        """
+        gram = _LinearGram(self.X, self.y, variables)
+        variables = gram.variables
+        directions = ['forward', 'backward']
+        if self.direction.lower() in directions:
+            directions = [self.direction.lower()]
+
+        # positions into variables; the order of subset matches the rows of gram_inv
+        subset = [] if 'forward' in directions else list(range(len(variables)))
+        gram_inv, beta, rss = gram.inverse(subset)
+        best_score = float(gram.score(rss, len(subset), self.criterion))
+        self.history_ = []
+        if self.verbose:
+            print('Variables: ' + ', '.join(variables))
+            print(f'Start: score={best_score:.2f}, constant')
+
+        while True:
+            # candidates in the same order as stepwise_selection, so ties are broken the same way
+            added = [i for i in range(len(variables)) if i not in subset] \
+                if 'forward' in directions else []
+            removed = list(range(len(subset))) if 'backward' in directions else []
+            step_rss = np.concatenate([
+                [rss],
+                gram.add_rss(subset, gram_inv, beta, rss, added),
+                gram.drop_rss(gram_inv, beta, rss)[removed],
+            ])
+            sizes = np.concatenate([
+                [len(subset)],
+                np.full(len(added), len(subset) + 1),
+                np.full(len(removed), len(subset) - 1),
+            ])
+            step_scores = gram.score(step_rss, sizes, self.criterion)
+
+            # the first entry with the lowest score is chosen
+            best = int(np.argmin(step_scores))
+            best_score, rss = float(step_scores[best]), step_rss[best]
+            if best == 0:
+                if self.verbose:
+                    print(f'Step: score={best_score:.2f}, unchanged None')
+                break
+            if best <= len(added):
+                chosen, direction = added[best - 1], 'add'
+                gram_inv, beta = gram.add(subset, gram_inv, beta, chosen)
+                subset.append(chosen)
+            else:
+                position, direction = removed[best - len(added) - 1], 'remove'
+                chosen = subset.pop(position)
+                gram_inv, beta = gram.drop(gram_inv, beta, position)
+            self.history_.append((best_score, variables[chosen], direction))
+            if self.verbose:
+                print(f'Step: score={best_score:.2f}, {direction} {variables[chosen]}')
+
+        self.best_variables_ = [variables[i] for i in subset]
+        self.best_score_ = best_score
+        self.best_model_ = None
+        if len(subset) > 0:
+            from sklearn.linear_model import LinearRegression
+
+            self.best_model_ = LinearRegression()
+            self.best_model_.fit(self.X[self.best_variables_], self.y)
+        return self.best_model_, self.best_variables_
+
+
+def _is_pipeline(pipeline):
+    from sklearn.pipeline import Pipeline
+
+    return isinstance(pipeline, Pipeline)
+
+
+def _neg_mean_squared_error(y_true, y_pred):
+    return -np.mean((np.asarray(y_true) - y_pred) ** 2)
+
+
+def _neg_mean_absolute_error(y_true, y_pred):
+    return -np.mean(np.abs(np.asarray(y_true) - y_pred))
+
+
+def _permutation_metric(estimator, scoring):
+    """ Metric computed from predictions for permutation importance, higher is better
+    Input:
+        estimator: the fitted final estimator of the pipeline
+        scoring: None for the estimator's default (accuracy or r2), 'r2', 'accuracy',
+            'neg_mean_squared_error', 'neg_mean_absolute_error' or a function(y_true, y_pred)
+    """
+    from sklearn.metrics import accuracy_score, r2_score
+
+    if callable(scoring):
+        return scoring
+    if scoring is None:
+        scoring = 'accuracy' if getattr(estimator, '_estimator_type', None) == 'classifier'\
+            or hasattr(estimator, 'classes_') else 'r2'
+    metrics = {'r2': r2_score, 'accuracy': accuracy_score,
+               'neg_mean_squared_error': _neg_mean_squared_error,
+               'neg_mean_absolute_error': _neg_mean_absolute_error}
+    if scoring not in metrics:
+        raise ValueError(f"scoring must be a function or one of {list(metrics)}")
+    return metrics[scoring]
+
+
+# state of a permutation importance worker, set once by _init_permutation_worker
+_PERMUTATION_STATE = {}
+
+
+def _init_permutation_worker(estimator, X, y, metric, batch_size):
+    _PERMUTATION_STATE.update(estimator=estimator, X=X, y=np.asarray(y), metric=metric,
+                              batch_size=batch_size)
+
+
+def _permute_columns(X, columns, rows):
+    """ Copy of X with the rows of `columns` reordered by `rows` """
+    import scipy.sparse as sp
+
+    if sp.issparse(X):
+        # X + (X[rows] - X) restricted to the columns, keeps X sparse
+        mask = np.zeros(X.shape[1])
+        mask[columns] = 1
+        return (X + (X[rows] - X) @ sp.diags(mask)).tocsr()
+    X = X.copy()
+    X[:, columns] = X[np.ix_(rows, columns)]
+    return X
+
+
+def _permutation_scores(columns, seed, n_repeats):
+    """ Scores of the model with `columns` permuted together, once per repeat """
+    import scipy.sparse as sp
+
+    state = _PERMUTATION_STATE
+    X, y, estimator, metric = state['X'], state['y'], state['estimator'], state['metric']
+    n_rows = X.shape[0]
+    rng = np.random.default_rng(seed)
+    permutations = [rng.permutation(n_rows) for _ in range(n_repeats)]
+    # several permuted copies are stacked so the model predicts in large batches
+    per_batch = max(1, state['batch_size'] // n_rows)
+    scores = []
+    for start in range(0, n_repeats, per_batch):
+        copies = [_permute_columns(X, columns, rows) for rows in permutations[start:start + per_batch]]
+        stacked = sp.vstack(copies, format='csr') if sp.issparse(X) else np.concatenate(copies)
+        predictions = estimator.predict(stacked)
+        scores.extend(metric(y, predictions[i * n_rows:(i + 1) * n_rows]) for i in range(len(copies)))
+    return np.array(scores)
+
+
 ## https://towardsdatascience.com/extracting-plotting-feature-names-importance-from-scikit-learn-pipelines-eb5bfa6a31f4#:~:text=get_selected_features%20calls%20get_feature_names.%20Then%20it%20tests%20for%20whether,were%20retained%20by%20the%20selector%20class%20or%20classes.
 class FeatureImportance:
 
@@ -205,12 +762,14 @@ class FeatureImportance:
     pipeline : a Scikit-learn Pipeline class where the a ColumnTransformer is the first element and model estimator is the last element
     verbose : a boolean. Whether to print all of the diagnostics. Default is False.
     
+    The feature names & selections are cached, until the pipeline is refitted.
+    
     Attributes
     __________
-    column_transformer_features :  A list of the feature names created by the ColumnTransformer prior to any selectors being applied
-    transformer_list : A list of the transformer names that correspond with the `column_transformer_features` attribute
-    discarded_features : A list of the features names that were not selected by a sklearn.feature_selection instance.
-    discarding_selectors : A list of the selector names corresponding with the `discarded_features` attribute
+    column_transformer_features :  An object array of the feature names created by the ColumnTransformer prior to any selectors being applied
+    transformer_list : An object array of the transformer names that correspond with the `column_transformer_features` attribute
+    discarded_features : An object array of the features names that were not selected by a sklearn.feature_selection instance.
+    discarding_selectors : An object array of the selector names corresponding with the `discarded_features` attribute
     feature_importance :  A Pandas Series containing the feature importance values and feature names as the index.    
     plot_importances_df : A Pandas DataFrame containing the subset of features and values that are actually displaced in the plot. 
     feature_info_df : A Pandas DataFrame that aggregates the other attributes. The index is column_transformer_features. The transformer column contains the transformer_list.
@@ -222,6 +781,108 @@ class FeatureImportance:
     def __init__(self, pipeline, verbose=False):
         self.pipeline = pipeline
         self.verbose = verbose
+        self._cache = {}
+        self._fitted_state = None
+
+
+    def _cached(self, key, compute):
+        """
+        Return the cached result of `compute`, the cache is cleared when the pipeline was refitted
+        """
+        # 'passthrough' and None steps have no fitted state
+        state = [[(name, value) for name, value in vars(step).items() if name.endswith('_')]
+                 if step is not None and not isinstance(step, str) else []
+                 for step in self.pipeline]
+        previous = self._fitted_state
+        # refitting replaces the fitted attributes, so an identity check is enough
+        if previous is None or len(previous) != len(state) or any(
+                len(old) != len(new) or any(o[0] != n[0] or o[1] is not n[1] for o, n in zip(old, new))
+                for old, new in zip(previous, state)):
+            self._cache.clear()
+            self._fitted_state = state
+        if key not in self._cache:
+            self._cache[key] = compute()
+        return self._cache[key]
+
+
+    @staticmethod
+    def _transformer_feature_names(column_transformer, transformer, orig_feature_names):
+        """
+        Names of the columns a fitted transformer of the ColumnTransformer creates, as an object array
+        """
+        from sklearn.pipeline import Pipeline
+
+        orig_feature_names = np.asarray(orig_feature_names, dtype=object)
+        if orig_feature_names.size and not isinstance(orig_feature_names[0], str)\
+                and hasattr(column_transformer, 'feature_names_in_'):
+            # columns given by position, e.g. the remainder
+            orig_feature_names = column_transformer.feature_names_in_[orig_feature_names.astype(int)]
+
+        if isinstance(transformer, str):
+            # 'passthrough'
+            return orig_feature_names.astype(object)
+
+        if isinstance(transformer, Pipeline):
+            # if pipeline, get the last transformer in the Pipeline
+            transformer = transformer.steps[-1][1]
+
+        if hasattr(transformer, 'get_feature_names'):
+            if 'input_features' in transformer.get_feature_names.__code__.co_varnames:
+                names = transformer.get_feature_names(orig_feature_names)
+            else:
+                names = transformer.get_feature_names()
+
+        elif hasattr(transformer, 'indicator_') and transformer.add_indicator:
+            # is this transformer one of the imputers & did it call the MissingIndicator?
+            missing_indicators = orig_feature_names[transformer.indicator_.features_] + '_missing_flag'
+            names = np.concatenate([orig_feature_names, missing_indicators])
+
+        elif hasattr(transformer, 'features_'):
+            # is this a MissingIndicator class? it only outputs the indicators
+            names = orig_feature_names[transformer.features_] + '_missing_flag'
+
+        elif hasattr(transformer, 'get_feature_names_out'):
+            names = transformer.get_feature_names_out(orig_feature_names)
+
+        else:
+            names = orig_feature_names
+
+        return np.asarray(names, dtype=object)
+
+
+    def _compute_feature_names(self, verbose):
+        from sklearn.compose import ColumnTransformer
+        from sklearn.utils.validation import check_is_fitted
+
+        column_transformer = self.pipeline[0]        
+        assert isinstance(column_transformer, ColumnTransformer), "Input isn't a ColumnTransformer"
+        check_is_fitted(column_transformer)
+
+        names, transformer_names = [], []
+
+        for i, transformer_item in enumerate(column_transformer.transformers_): 
+            
+            transformer_name, transformer, orig_feature_names = transformer_item
+            
+            if verbose: 
+                print('\n\n', i, '. Transformer/Pipeline: ', transformer_name, ',', 
+                      transformer.__class__.__name__, '\n')
+                print('\tn_orig_feature_names:', len(orig_feature_names))
+
+            if isinstance(transformer, str) and transformer == 'drop':
+                continue
+
+            transformer_names.append(transformer_name)
+            names.append(self._transformer_feature_names(column_transformer, transformer, orig_feature_names))
+
+            if verbose: 
+                print('\tn_new_features:', len(names[-1]))
+                print('\tnew_features:\n', names[-1].tolist())
+
+        features = np.concatenate(names) if names else np.empty(0, dtype=object)
+        transformer_list = np.repeat(np.asarray(transformer_names, dtype=object),
+                                     [len(n) for n in names])
+        return features, transformer_list
 
 
     def get_feature_names(self, verbose=None):  
@@ -246,70 +907,52 @@ class FeatureImportance:
             verbose = self.verbose
             
         if verbose: print('''\n\n---------\nRunning get_feature_names\n---------\n''')
-        
-        column_transformer = self.pipeline[0]        
-        assert isinstance(column_transformer, ColumnTransformer), "Input isn't a ColumnTransformer"
-        check_is_fitted(column_transformer)
 
-        new_feature_names, transformer_list = [], []
+        features, transformer_list = self._cached('feature_names', lambda: self._compute_feature_names(verbose))
 
-        for i, transformer_item in enumerate(column_transformer.transformers_): 
-            
-            transformer_name, transformer, orig_feature_names = transformer_item
-            orig_feature_names = list(orig_feature_names)
-            
-            if verbose: 
-                print('\n\n', i, '. Transformer/Pipeline: ', transformer_name, ',', 
-                      transformer.__class__.__name__, '\n')
-                print('\tn_orig_feature_names:', len(orig_feature_names))
+        self.transformer_list, self.column_transformer_features = transformer_list, features
 
-            if transformer == 'drop':
-                    
-                continue
-                
-            if isinstance(transformer, Pipeline):
-                # if pipeline, get the last transformer in the Pipeline
-                transformer = transformer.steps[-1][1]
-
-            if hasattr(transformer, 'get_feature_names'):
+        return features.tolist()
 
-                if 'input_features' in transformer.get_feature_names.__code__.co_varnames:
 
-                    names = list(transformer.get_feature_names(orig_feature_names))
+    def _compute_selection(self, verbose):
+        from sklearn.utils.validation import check_is_fitted
 
-                else:
+        features = self.column_transformer_features
+        # position of the retained features in column_transformer_features
+        retained = np.arange(len(features))
+        # index in selector_names of the step that discarded each feature, -1 if retained
+        discarded_by = np.full(len(features), -1)
+        selector_names = []
 
-                    names = list(transformer.get_feature_names())
-
-            elif hasattr(transformer,'indicator_') and transformer.add_indicator:
-                # is this transformer one of the imputers & did it call the MissingIndicator?
-
-                missing_indicator_indices = transformer.indicator_.features_
-                missing_indicators = [orig_feature_names[idx] + '_missing_flag'\
-                                      for idx in missing_indicator_indices]
-                names = orig_feature_names + missing_indicators
-
-            elif hasattr(transformer,'features_'):
-                # is this a MissingIndicator class? 
-                missing_indicator_indices = transformer.features_
-                missing_indicators = [orig_feature_names[idx] + '_missing_flag'\
-                                      for idx in missing_indicator_indices]
+        for i, step_item in enumerate(self.pipeline.steps[:]):
+            
+            step_name, step = step_item
 
-            else:
+            if hasattr(step, 'get_support'):
 
-                names = orig_feature_names
+                if verbose: print('\nStep ', i, ": ", step_name, ',', 
+                                  step.__class__.__name__, '\n')
+                    
+                check_is_fitted(step)
 
-            if verbose: 
-                print('\tn_new_features:', len(names))
-                print('\tnew_features:\n', names)
+                mask = np.asarray(step.get_support(), dtype=bool)
+                discarded_by[retained[~mask]] = len(selector_names)
+                selector_names.append(step_name)
+                retained = retained[mask]
 
-            new_feature_names.extend(names)
-            transformer_list.extend([transformer_name] * len(names))
-        
-        self.transformer_list, self.column_transformer_features = transformer_list,\
-                                                                    new_feature_names
+                if verbose: 
+                    n_discarded = len(mask) - len(retained)
+                    print(f'\t{len(retained)} retained, {n_discarded} discarded')
+                    if n_discarded > 0:
+                        print('\n\tdiscarded_features:\n\n', 
+                              features[discarded_by == len(selector_names) - 1].tolist())
 
-        return new_feature_names
+        discarded = np.flatnonzero(discarded_by >= 0)
+        # discarded features grouped by the selector that removed them
+        discarded = discarded[np.argsort(discarded_by[discarded], kind='stable')]
+        discarding_selectors = np.asarray(selector_names, dtype=object)[discarded_by[discarded]]
+        return retained, discarded, discarding_selectors
 
     
     def get_selected_features(self, verbose=None):
@@ -326,104 +969,164 @@ class FeatureImportance:
         if verbose is None:
             verbose = self.verbose
 
-        assert isinstance(self.pipeline, Pipeline), "Input isn't a Pipeline"
+        assert _is_pipeline(self.pipeline), "Input isn't a Pipeline"
 
-        features = self.get_feature_names()
+        self.get_feature_names()
         
         if verbose: print('\n\n---------\nRunning get_selected_features\n---------\n')
-            
-        all_discarded_features, discarding_selectors = [], []
 
-        for i, step_item in enumerate(self.pipeline.steps[:]):
-            
-            step_name, step = step_item
-
-            if hasattr(step, 'get_support'):
-
-                if verbose: print('\nStep ', i, ": ", step_name, ',', 
-                                  step.__class__.__name__, '\n')
-                    
-                check_is_fitted(step)
+        retained, discarded, discarding_selectors = \
+            self._cached('selection', lambda: self._compute_selection(verbose))
 
-                feature_mask_dict = dict(zip(features, step.get_support()))
-                
-                features = [feature for feature, is_retained in feature_mask_dict.items()\
-                            if is_retained]
-                                         
-                discarded_features = [feature for feature, is_retained in feature_mask_dict.items()\
-                                      if not is_retained]
-                
-                all_discarded_features.extend(discarded_features)
-                discarding_selectors.extend([step_name] * len(discarded_features))
-                
-                
-                if verbose: 
-                    print(f'\t{len(features)} retained, {len(discarded_features)} discarded')
-                    if len(discarded_features) > 0:
-                        print('\n\tdiscarded_features:\n\n', discarded_features)
-
-        self.discarded_features, self.discarding_selectors = all_discarded_features,\
-                                                                discarding_selectors
+        self._retained_positions, self._discarded_positions = retained, discarded
+        self.discarded_features, self.discarding_selectors = \
+            self.column_transformer_features[discarded], discarding_selectors
         
-        return features
+        return self.column_transformer_features[retained].tolist()
 
-    def get_feature_importance(self):
+    def get_feature_importance(self, method='model', X=None, y=None, n_repeats=5, scoring=None,
+                               group_transformers=None, random_state=None, n_jobs=None,
+                               batch_size=100_000):
         
         """
         Creates a Pandas Series where values are the feature importance values from the model and feature names are set as the index. 
         
         This Series is stored in the `feature_importance` attribute.
+        Parameters
+        ----------
+        method : 'model' (default) reads the feature_importances_ of the final estimator. 
+            'permutation' measures how much the score on X, y drops when a feature is shuffled, 
+            this works for any estimator. The standard deviation over the repeats is stored in the 
+            `feature_importance_std` attribute.
+        X, y : the data to score the permutations on, preferably held-out data. Required for 'permutation'.
+        n_repeats : the number of times each feature is shuffled. Default is 5.
+        scoring : None (accuracy for classifiers, r2 otherwise), 'r2', 'accuracy', 'neg_mean_squared_error', 
+            'neg_mean_absolute_error' or a function(y_true, y_pred) where higher is better.
+        group_transformers : transformer names (or True for all) whose features are shuffled together 
+            (e.g. the columns of a OneHotEncoder) and reported as one feature named after the transformer.
+        random_state : seed for the permutations, the result does not depend on n_jobs.
+        n_jobs : number of worker processes; None or 1 runs in this process, -1 uses all cores.
+        batch_size : the approximate number of rows the estimator predicts at once. Default is 100,000.
         Returns
         -------
         A pandas Series containing the feature importance values and feature names as the index.
         
         """
         
-        assert isinstance(self.pipeline, Pipeline), "Input isn't a Pipeline"
+        assert _is_pipeline(self.pipeline), "Input isn't a Pipeline"
 
-        features = self.get_selected_features()
-             
-        assert hasattr(self.pipeline[-1], 'feature_importances_'),\
-            "The last element in the pipeline isn't an estimator with a feature_importances_ attribute"
-        
-        importance_values = self.pipeline[-1].feature_importances_
+        self.get_selected_features()
+        retained = self._retained_positions
+        features = self.column_transformer_features[retained]
+
+        if method == 'model':
+            assert hasattr(self.pipeline[-1], 'feature_importances_'),\
+                "The last element in the pipeline isn't an estimator with a feature_importances_ attribute"
+            importance_values = self.pipeline[-1].feature_importances_
+            groups = [[i] for i in range(len(features))]
+            names = features
+        elif method == 'permutation':
+            assert X is not None and y is not None, "X and y are required for permutation importance"
+            names, groups = self._permutation_groups(features, group_transformers)
+            importance_values, std = self._permutation_importance(X, y, groups, n_repeats, scoring,
+                                                                  random_state, n_jobs, batch_size)
+            self.feature_importance_std = pd.Series(std, index=names)
+        else:
+            raise ValueError("method must be 'model' or 'permutation'")
         
-        assert len(features) == len(importance_values),\
+        assert sum(len(g) for g in groups) == len(retained),\
             "The number of feature names & importance values doesn't match"
         
-        feature_importance = pd.Series(importance_values, index=features)
+        feature_importance = pd.Series(importance_values, index=names)
         self.feature_importance = feature_importance
         
-        # create feature_info_df
-        column_transformer_df =\
-            pd.DataFrame(dict(transformer=self.transformer_list),
-                         index=self.column_transformer_features)
+        # create feature_info_df, positionally so repeated feature names are not joined with each other
+        # (grouped features all get the importance of their group)
+        n_features = len(self.column_transformer_features)
+        value = np.full(n_features, np.nan)
+        value[retained[np.concatenate(groups)]] = np.repeat(importance_values, [len(g) for g in groups])
+        discarding_selector = np.full(n_features, np.nan, dtype=object)
+        discarding_selector[self._discarded_positions] = self.discarding_selectors
+        is_retained = np.zeros(n_features, dtype=bool)
+        is_retained[retained] = True
 
-        discarded_features_df =\
-            pd.DataFrame(dict(discarding_selector=self.discarding_selectors),
-                         index=self.discarded_features)
+        self.feature_info_df = pd.DataFrame(
+            dict(transformer=self.transformer_list, value=value,
+                 discarding_selector=discarding_selector, is_retained=is_retained),
+            index=self.column_transformer_features)
 
-        importance_df = self.feature_importance.rename('value').to_frame()
+        return feature_importance
 
-        self.feature_info_df = \
-            column_transformer_df\
-            .join([importance_df, discarded_features_df])\
-            .assign(is_retained = lambda df: ~df.value.isna())        
 
+    def _permutation_groups(self, features, group_transformers):
+        """
+        Names and column positions of the features that are shuffled together
+        """
+        transformers = self.transformer_list[self._retained_positions]
+        if group_transformers is None:
+            group_transformers = []
+        elif group_transformers is True:
+            group_transformers = transformers
+        elif isinstance(group_transformers, str):
+            group_transformers = [group_transformers]
+        grouped = np.isin(transformers, list(group_transformers))
+        names, groups = [], []
+        for transformer in pd.unique(transformers[grouped]):
+            names.append(transformer)
+            groups.append(np.flatnonzero(transformers == transformer))
+        single = np.flatnonzero(~grouped)
+        names.extend(features[single])
+        groups.extend([i] for i in single)
+        return np.asarray(names, dtype=object), groups
 
-        return feature_importance
+
+    def _permutation_importance(self, X, y, groups, n_repeats, scoring, random_state, n_jobs,
+                                batch_size):
+        """
+        Mean and standard deviation of the drop in score when the columns of each group are shuffled
+        """
+        estimator = self.pipeline[-1]
+        # the transformers and selectors run once, only the transformed matrix is shuffled
+        import scipy.sparse as sp
+
+        X_transformed = self.pipeline[:-1].transform(X)
+        if sp.issparse(X_transformed):
+            X_transformed = X_transformed.tocsr()
+        else:
+            X_transformed = np.asarray(X_transformed)
+        metric = _permutation_metric(estimator, scoring)
+        baseline = metric(y, estimator.predict(X_transformed))
+
+        # one independent stream of permutations per group, whichever process runs it
+        seeds = np.random.SeedSequence(random_state).spawn(len(groups))
+        state = (estimator, X_transformed, y, metric, batch_size)
+        task = partial(_permutation_scores, n_repeats=n_repeats)
+        if n_jobs is None or n_jobs == 1:
+            _init_permutation_worker(*state)
+            try:
+                scores = list(map(task, groups, seeds))
+            finally:
+                _PERMUTATION_STATE.clear()
+        else:
+            max_workers = os.cpu_count() if n_jobs == -1 else n_jobs
+            with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_permutation_worker,
+                                     initargs=state) as pool:
+                scores = list(pool.map(task, groups, seeds))
+
+        drops = baseline - np.array(scores).reshape(len(groups), n_repeats)
+        return drops.mean(axis=1), drops.std(axis=1)
         
     
     def plot(self, top_n_features=100, rank_features=True, max_scale=True, 
              display_imp_values=True, display_imp_value_decimals=1,
              height_per_feature=25, orientation='h', width=750, height=None, 
              str_pad_width=15, yaxes_tickfont_family='Courier New', 
-             yaxes_tickfont_size=15):
+             yaxes_tickfont_size=15, output=None, show=True, **importance_kwargs):
         """
         Plot the Feature Names & Importances 
         Parameters
         ----------
-        top_n_features : the number of features to plot, default is 100
+        top_n_features : the number of features with the largest absolute importance to plot, default is 100
         rank_features : whether to rank the features with integers, default is True
         max_scale : Should the importance values be scaled by the maximum value & mulitplied by 100?  Default is True.
         display_imp_values : Should the importance values be displayed? Default is True.
@@ -439,54 +1142,51 @@ class FeatureImportance:
             It can also be set to 0.
         yaxes_tickfont_family : the font for the feature names. Default is Courier New.
         yaxes_tickfont_size : the font size for the feature names. Default is 15.
+        output : optional file to save the plot to, a .html file (loading plotly.js from a CDN) 
+            or a static image such as .png or .svg (requires kaleido).
+        show : whether to display the plot. Default is True.
+        importance_kwargs : passed on to get_feature_importance, e.g. method='permutation', X=X_valid, y=y_valid
         Returns
         -------
-        plot
+        plotly Figure
         """
+        import plotly.express as px
+
         if height is None:
             height = top_n_features * height_per_feature
             
-        # prep the data
+        # prep the data, only the plotted features are put in a DataFrame
         
-        all_importances = self.get_feature_importance()
+        all_importances = self.get_feature_importance(**importance_kwargs)
         n_all_importances = len(all_importances)
-        
-        plot_importances_df =\
-            all_importances\
-            .nlargest(top_n_features)\
-            .sort_values()\
-            .to_frame('value')\
-            .rename_axis('feature')\
-            .reset_index()
+        values = all_importances.to_numpy(dtype=float)
+        magnitude = np.abs(values)
+
+        n_plotted = min(top_n_features, n_all_importances)
+        top = np.arange(n_all_importances)
+        if n_plotted < n_all_importances:
+            top = np.argpartition(-magnitude, n_plotted - 1)[:n_plotted]
+        # smallest first, so the largest bar is at the top
+        top = top[np.argsort(magnitude[top], kind='stable')]
+
+        plot_importances_df = pd.DataFrame(
+            dict(feature=all_importances.index.to_numpy()[top].astype(str), value=values[top]))
                 
         if max_scale:
             plot_importances_df['value'] = \
-                                plot_importances_df.value.abs() /\
-                                plot_importances_df.value.abs().max() * 100
+                                magnitude[top] / magnitude[top].max() * 100
             
         self.plot_importances_df = plot_importances_df.copy()
         
-        if len(all_importances) < top_n_features:
+        if n_all_importances < top_n_features:
             title_text = 'All Feature Importances'
         else:
             title_text = f'Top {top_n_features} (of {n_all_importances}) Feature Importances'       
         
         if rank_features:
-            padded_features = \
-                plot_importances_df.feature\
-                .str.pad(width=str_pad_width)\
-                .values
-            
-            ranked_features =\
-                plot_importances_df.index\
-                .to_series()\
-                .sort_values(ascending=False)\
-                .add(1)\
-                .astype(str)\
-                .str.cat(padded_features, sep='. ')\
-                .values
-
-            plot_importances_df['feature'] = ranked_features
+            ranks = range(n_plotted, 0, -1)
+            plot_importances_df['feature'] = [f'{rank}. {feature.rjust(str_pad_width)}' for rank, feature 
+                                              in zip(ranks, plot_importances_df.feature)]
         
         if display_imp_values:
             text = plot_importances_df.value.round(display_imp_value_decimals)
@@ -507,4 +1207,11 @@ class FeatureImportance:
         fig.update_yaxes(tickfont=dict(family=yaxes_tickfont_family, 
                                        size=yaxes_tickfont_size),
                          title='')
-        fig.show()
+        if output is not None:
+            if str(output).lower().endswith(('.html', '.htm')):
+                fig.write_html(output, include_plotlyjs='cdn', full_html=True)
+            else:
+                fig.write_image(output)
+        if show:
+            fig.show()
+        return fig
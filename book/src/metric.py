@@ -5,8 +5,15 @@ Applications in Python"
 '''
 import math
 import numpy as np
-from sklearn.metrics import r2_score, mean_squared_error
-from sklearn.metrics import confusion_matrix, accuracy_score
+import pandas as pd
+
+
+def __getattr__(name):
+    # sklearn is imported on first use, confusion_matrix stays importable from this module
+    if name == 'confusion_matrix':
+        from sklearn.metrics import confusion_matrix
+        return confusion_matrix
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def adjusted_r2_score(y_true, y_pred, model):
@@ -20,6 +27,7 @@ def adjusted_r2_score(y_true, y_pred, model):
     p = len(model.coef_)
     if p >= n - 1:
         return 0
+    from sklearn.metrics import r2_score
     r2 = r2_score(y_true, y_pred)
     return 1 - (1 - r2) * (n - 1) / (n - p - 1)
 
@@ -39,8 +47,7 @@ def AIC_score(y_true, y_pred, model=None, df=None):
     p = len(model.coef_) + 1 if df is None else df
     resid = np.array(y_true) - np.array(y_pred)
     sse = np.sum(resid ** 2)
-    constant = n + n * np.log(2 * np.pi)
-    return n * math.log(sse / n) + constant + 2 * (p + 1)
+    return _aic_from_sse(sse, n, p)
 
 
 def BIC_score(y_true, y_pred, model=None, df=None):
@@ -57,25 +64,88 @@ def BIC_score(y_true, y_pred, model=None, df=None):
     return aic - 2 * (p + 1) + math.log(n) * (p + 1)
 
 
+def _aic_from_sse(sse, n, df):
+    """ AIC from the sum of squared errors; works on scalars and arrays
+    Input:
+        sse: sum of squared errors
+        n: number of observations
+        df: degrees of freedom of model (coefficients + intercept)
+    """
+    constant = n + n * np.log(2 * np.pi)
+    return n * np.log(sse / n) + constant + 2 * (np.asarray(df) + 1)
+
+
+def _bic_from_sse(sse, n, df):
+    """ BIC from the sum of squared errors; works on scalars and arrays """
+    df = np.asarray(df)
+    return _aic_from_sse(sse, n, df) - 2 * (df + 1) + math.log(n) * (df + 1)
+
+
+def _adjusted_r2_from_sse(sse, sst, n, p):
+    """ adjusted R2 from the sum of squared errors and total sum of squares
+    Input:
+        sse: sum of squared errors
+        sst: total sum of squares around the mean
+        n: number of observations
+        p: number of coefficients (excluding the intercept)
+    """
+    p = np.asarray(p)
+    r2 = 1 - sse / sst
+    with np.errstate(divide='ignore', invalid='ignore'):
+        adj = 1 - (1 - r2) * (n - 1) / (n - p - 1)
+    return np.where(p >= n - 1, 0, adj)
+
+
+_REGRESSION_METRIC_NAMES = {
+    'ME': 'Mean Error (ME)',
+    'RMSE': 'Root Mean Squared Error (RMSE)',
+    'MAE': 'Mean Absolute Error (MAE)',
+    'MPE': 'Mean Percentage Error (MPE)',
+    'MAPE': 'Mean Absolute Percentage Error (MAPE)',
+}
+
+
+def regression_metrics(y_true, y_pred):
+    """ calculate regression performance metrics
+    Input:
+        y_true: actual values
+        y_pred: predicted values, either one vector or a 2-D array with one row of
+            predictions per model (models x rows)
+    Returns:
+        dict with ME, RMSE and MAE, and MPE and MAPE if none of the actual values are 0.
+        For 2-D y_pred a DataFrame with one row per model.
+    """
+    y_true = _toArray(y_true).astype(float, copy=False)
+    index = y_pred.index if isinstance(y_pred, pd.DataFrame) else None
+    y_pred = _toArray(y_pred).astype(float, copy=False)
+    if y_pred.shape[-1] != len(y_true):
+        raise ValueError('y_pred needs to have one prediction for each value in y_true')
+
+    # compute the residuals once and reduce along the rows
+    n = len(y_true)
+    y_res = y_true - y_pred
+    metrics = {
+        'ME': y_res.sum(axis=-1) / n,
+        'RMSE': np.sqrt(np.einsum('...i,...i->...', y_res, y_res) / n),
+        'MAE': np.abs(y_res).sum(axis=-1) / n,
+    }
+    if np.all(y_true != 0):
+        y_pct = y_res / y_true
+        metrics['MPE'] = 100 * y_pct.sum(axis=-1) / n
+        metrics['MAPE'] = 100 * np.abs(y_pct).sum(axis=-1) / n
+    if y_pred.ndim == 1:
+        return {name: float(value) for name, value in metrics.items()}
+    return pd.DataFrame(metrics, index=index)
+
+
 def regressionSummary(y_true, y_pred):
     """ print regression performance metrics
     Input:
         y_true: actual values
         y_pred: predicted values
     """
-    y_true = _toArray(y_true)
-    y_pred = _toArray(y_pred)
-    y_res = y_true - y_pred
-    metrics = [
-        ('Mean Error (ME)', sum(y_res) / len(y_res)),
-        ('Root Mean Squared Error (RMSE)', math.sqrt(mean_squared_error(y_true, y_pred))),
-        ('Mean Absolute Error (MAE)', sum(abs(y_res)) / len(y_res)),
-    ]
-    if all(yt != 0 for yt in y_true):
-        metrics.extend([
-            ('Mean Percentage Error (MPE)', 100 * sum(y_res / y_true) / len(y_res)),
-            ('Mean Absolute Percentage Error (MAPE)', 100 * sum(abs(y_res / y_true) / len(y_res))),
-        ])
+    metrics = [(_REGRESSION_METRIC_NAMES[name], value)
+               for name, value in regression_metrics(y_true, y_pred).items()]
     maxlength = max(len(m[0]) for m in metrics)
     fmt1 = f'{{:>{maxlength}}} : {{:.4f}}'
     print('\nRegression statistics\n')
@@ -90,20 +160,88 @@ def _toArray(y):
     return y
 
 
-def classificationSummary(y_true, y_pred, class_names=None):
+def classification_metrics(y_true, y_pred, labels=None):
+    """ calculate classification performance metrics from a single confusion matrix pass
+    Input:
+        y_true: actual values
+        y_pred: predicted values, either one vector or a 2-D array with one row of
+            predictions per model (models x rows)
+        labels (optional): list of class labels, default the sorted labels found in the data;
+            values that aren't in labels are ignored
+    Returns:
+        dict with labels, confusion_matrix (rows actual, columns predicted), accuracy, and
+        per class precision, recall and f1. For 2-D y_pred each entry except labels has an
+        additional leading dimension for the models.
+    """
+    y_true = _toArray(y_true)
+    y_pred = _toArray(y_pred)
+    if y_pred.shape[-1] != len(y_true):
+        raise ValueError('y_pred needs to have one prediction for each value in y_true')
+    if labels is None:
+        labels = np.unique(np.concatenate([y_true, y_pred.ravel()]))
+    labels = np.asarray(labels)
+    nlabels = len(labels)
+
+    # map the values to label codes; -1 for values that aren't a label
+    sorter = np.argsort(labels, kind='stable')
+
+    def encode(values):
+        position = np.searchsorted(labels, values, sorter=sorter).clip(max=nlabels - 1)
+        codes = sorter[position]
+        return np.where(labels[codes] == values, codes, -1)
+
+    true_codes = encode(y_true)
+    pred_codes = encode(y_pred)
+
+    # one bincount over all models, the actual codes are offset by the model number
+    nmodels = 1 if y_pred.ndim == 1 else len(y_pred)
+    valid = (true_codes >= 0) & (pred_codes >= 0)
+    offsets = np.arange(nmodels).reshape(-1, 1) * nlabels if y_pred.ndim == 2 else 0
+    true_codes = np.broadcast_to(true_codes + offsets, valid.shape)
+    confusion = _confusion_counts(true_codes[valid], pred_codes[valid], nlabels, nmodels)
+    if y_pred.ndim == 1:
+        confusion = confusion[0]
+    return dict(labels=labels, **_metrics_from_confusion(confusion))
+
+
+def _metrics_from_confusion(confusion):
+    """ accuracy, precision, recall and f1 from (a stack of) confusion matrices """
+    true_positives = np.diagonal(confusion, axis1=-2, axis2=-1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        accuracy = true_positives.sum(axis=-1) / confusion.sum(axis=(-2, -1))
+        precision = np.nan_to_num(true_positives / confusion.sum(axis=-2))
+        recall = np.nan_to_num(true_positives / confusion.sum(axis=-1))
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    if confusion.ndim == 2:
+        accuracy = float(accuracy)
+    return {
+        'confusion_matrix': confusion,
+        'accuracy': accuracy,
+        'precision': precision,
+        'recall': recall,
+        'f1': f1,
+    }
+
+
+def classificationSummary(y_true=None, y_pred=None, class_names=None, metrics=None):
     """ Print a summary of classification performance
     Input:
         y_true: actual values
         y_pred: predicted values
         class_names (optional): list of class names
+        metrics (optional): result of classification_metrics for a single model, used
+            instead of y_true and y_pred
     """
-    confusionMatrix = confusion_matrix(y_true, y_pred)
-    accuracy = accuracy_score(y_true, y_pred)
+    if metrics is None:
+        metrics = classification_metrics(y_true, y_pred)
+    if np.ndim(metrics['confusion_matrix']) != 2:
+        raise ValueError('The summary can only be printed for a single model')
+    accuracy = metrics['accuracy']
 
     print(f'Confusion Matrix (Accuracy {accuracy:.4f})\n')
 
     # Pretty-print confusion matrix
-    cm = confusionMatrix
+    cm = metrics['confusion_matrix']
 
     labels = class_names
     if labels is None:
@@ -131,4 +269,135 @@ def classificationSummary(y_true, y_pred, class_names=None):
 
     for cls, row in zip(labels, cm):
         print(fmt1.format(cls), end='')
-        print(fmt2.format(*row))
\ No newline at end of file
+        print(fmt2.format(*row))
+
+
+def _confusion_counts(true_codes, pred_codes, nlabels, nmodels=1):
+    """ Confusion matrices (models x actual x predicted) from integer label codes with a
+    single bincount pass; the actual codes of model i are offset by i * nlabels """
+    counts = np.bincount(true_codes * nlabels + pred_codes, minlength=nmodels * nlabels * nlabels)
+    return counts.reshape(nmodels, nlabels, nlabels)
+
+
+class RegressionAccumulator:
+    """ Accumulate regression errors over chunks of data
+
+    Keeps running sums instead of the predictions, so the metrics of regression_metrics, AIC and
+    BIC can be computed over data that doesn't fit in memory, e.g. a pd.read_csv(chunksize=...)
+    stream. Accumulators of parallel workers are combined with merge.
+    Example:
+        acc = RegressionAccumulator()
+        for chunk in pd.read_csv('predictions.csv', chunksize=100_000):
+            acc.update(chunk['actual'], chunk['predicted'])
+        acc.result()
+    """
+    def __init__(self):
+        self.n = 0
+        self.sum_res = 0.0
+        self.sse = 0.0
+        self.sae = 0.0
+        self.sum_pct = 0.0
+        self.sum_abs_pct = 0.0
+        self.has_zero = False
+
+    def update(self, y_true, y_pred):
+        """ Add a chunk of actual and predicted values """
+        y_true = _toArray(y_true).astype(float, copy=False)
+        y_pred = _toArray(y_pred).astype(float, copy=False)
+        y_res = y_true - y_pred
+        self.n += len(y_res)
+        self.sum_res += y_res.sum()
+        self.sse += y_res @ y_res
+        self.sae += np.abs(y_res).sum()
+        if not self.has_zero:
+            self.has_zero = not np.all(y_true != 0)
+        if not self.has_zero:
+            y_pct = y_res / y_true
+            self.sum_pct += y_pct.sum()
+            self.sum_abs_pct += np.abs(y_pct).sum()
+        return self
+
+    def merge(self, other):
+        """ Add the sums of another accumulator, e.g. from a parallel worker """
+        self.n += other.n
+        self.sum_res += other.sum_res
+        self.sse += other.sse
+        self.sae += other.sae
+        self.sum_pct += other.sum_pct
+        self.sum_abs_pct += other.sum_abs_pct
+        self.has_zero = self.has_zero or other.has_zero
+        return self
+
+    def result(self):
+        """ Return the same dict as regression_metrics for all data seen so far """
+        if self.n == 0:
+            raise ValueError('No data has been accumulated')
+        metrics = {
+            'ME': self.sum_res / self.n,
+            'RMSE': math.sqrt(self.sse / self.n),
+            'MAE': self.sae / self.n,
+        }
+        if not self.has_zero:
+            metrics['MPE'] = 100 * self.sum_pct / self.n
+            metrics['MAPE'] = 100 * self.sum_abs_pct / self.n
+        return {name: float(value) for name, value in metrics.items()}
+
+    def AIC_score(self, model=None, df=None):
+        """ AIC for all data seen so far, see AIC_score """
+        if df is None and model is None:
+            raise ValueError('You need to provide either model or df')
+        p = len(model.coef_) + 1 if df is None else df
+        return float(_aic_from_sse(self.sse, self.n, p))
+
+    def BIC_score(self, model=None, df=None):
+        """ BIC for all data seen so far, see BIC_score """
+        if df is None and model is None:
+            raise ValueError('You need to provide either model or df')
+        p = len(model.coef_) + 1 if df is None else df
+        return float(_bic_from_sse(self.sse, self.n, p))
+
+
+class ClassificationAccumulator:
+    """ Accumulate confusion matrix counts over chunks of data
+
+    Labels are collected as they appear and kept sorted, matching the order used by
+    sklearn's confusion_matrix. Accumulators of parallel workers are combined with merge.
+    Input:
+        labels (optional): list of all class labels, if known in advance
+    """
+    def __init__(self, labels=None):
+        self.labels = np.array([]) if labels is None else np.unique(np.asarray(labels))
+        self.counts = np.zeros((len(self.labels), len(self.labels)), dtype=np.int64)
+
+    def _add_labels(self, labels):
+        if len(labels) == 0:
+            return
+        all_labels = np.union1d(self.labels, labels) if len(self.labels) else np.unique(labels)
+        if len(all_labels) != len(self.labels):
+            positions = np.searchsorted(all_labels, self.labels)
+            counts = np.zeros((len(all_labels), len(all_labels)), dtype=np.int64)
+            counts[np.ix_(positions, positions)] = self.counts
+            self.labels, self.counts = all_labels, counts
+
+    def update(self, y_true, y_pred):
+        """ Add a chunk of actual and predicted classes """
+        y_true = _toArray(y_true)
+        y_pred = _toArray(y_pred)
+        self._add_labels(np.unique(np.concatenate([y_true, y_pred])))
+        nlabels = len(self.labels)
+        self.counts += _confusion_counts(np.searchsorted(self.labels, y_true),
+                                         np.searchsorted(self.labels, y_pred), nlabels)[0]
+        return self
+
+    def merge(self, other):
+        """ Add the counts of another accumulator, e.g. from a parallel worker """
+        self._add_labels(other.labels)
+        positions = np.searchsorted(self.labels, other.labels)
+        self.counts[np.ix_(positions, positions)] += other.counts
+        return self
+
+    def result(self):
+        """ Return the same dict as classification_metrics for all data seen so far """
+        if self.counts.sum() == 0:
+            raise ValueError('No data has been accumulated')
+        return dict(labels=self.labels, **_metrics_from_confusion(self.counts.copy()))
@@ -0,0 +1,199 @@
+"""
+Read the laptop sales databases (built by scripts/setup_laptop_db.py)
+with the filtering and aggregation done by SQLite instead of pandas
+"""
+import sqlite3
+import threading
+from pathlib import Path
+
+import pandas as pd
+
+try:
+    from .data import _data_dir
+except ImportError:
+    from data import _data_dir
+
+SALES_DB = "laptopsales.db"
+JUNE_SALES_DB = "june_laptopsales.db"
+SALES_TABLE = "sales"
+DATE_COLUMN = "sale_date"
+
+# SQL for the aggregate functions accepted by `read_sales`
+AGGREGATES = {"sum": "SUM", "mean": "AVG", "min": "MIN", "max": "MAX", "count": "COUNT"}
+# strftime formats for the date rollups, sale_date is stored as 'YYYY-MM-DD HH:MM:SS'
+FREQUENCIES = {"year": "%Y", "month": "%Y-%m", "day": "%Y-%m-%d", "hour": "%Y-%m-%d %H:00"}
+
+# one read-only connection per database and thread
+_POOL = threading.local()
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _database_path(database) -> Path:
+    path = Path(database)
+    return path if path.is_absolute() else _data_dir() / path
+
+
+def get_connection(database=SALES_DB) -> sqlite3.Connection:
+    """
+    Pooled read-only connection to a database in DATA_DIR
+    Parameters:
+    ----------
+    database : str or Path, default SALES_DB
+        file name in DATA_DIR, or an absolute path
+    Return:
+    ------
+    sqlite3.Connection
+    """
+    path = _database_path(database).resolve()
+    connections = _POOL.__dict__.setdefault("connections", {})
+    conn = connections.get(path)
+    if conn is None:
+        if not path.exists():
+            raise FileNotFoundError(f"{path} not found, run scripts/setup_laptop_db.py")
+        conn = sqlite3.connect(f"{path.as_uri()}?mode=ro", uri=True)
+        connections[path] = conn
+    return conn
+
+
+def close_connections():
+    """
+    Close the pooled connections of this thread
+    """
+    for conn in _POOL.__dict__.pop("connections", {}).values():
+        conn.close()
+
+
+def table_columns(table=SALES_TABLE, database=SALES_DB) -> list:
+    """
+    Names of the columns of `table`
+    """
+    columns = [row[1] for row in get_connection(database).execute(f"PRAGMA table_info({_quote(table)})")]
+    if not columns:
+        raise ValueError(f"table {table} not found in {database}")
+    return columns
+
+
+def _check_columns(columns, available, table):
+    unknown = [c for c in columns if c not in available]
+    if unknown:
+        raise ValueError(f"columns {unknown} not found in table {table}")
+
+
+def _list(value):
+    return [value] if isinstance(value, str) else list(value)
+
+
+def _date_text(value):
+    return pd.Timestamp(value).strftime("%Y-%m-%d %H:%M:%S")
+
+
+def build_query(columns=None, start=None, end=None, group_by=None, aggregates=None, freq=None,
+                table=SALES_TABLE, database=SALES_DB):
+    """
+    Parameterized SELECT statement for `read_sales`, the table and
+    column names are checked against the table definition
+    Return:
+    ------
+    tuple
+        the SQL and its parameters
+    """
+    available = table_columns(table, database)
+    group_by = [] if group_by is None else _list(group_by)
+    aggregates = {} if aggregates is None else dict(aggregates)
+    _check_columns(group_by + list(aggregates), available, table)
+
+    select, params = [], []
+    keys = []
+    if freq is not None:
+        if freq not in FREQUENCIES:
+            raise ValueError(f"freq must be one of {list(FREQUENCIES)}")
+        select.append(f"strftime(?, {_quote(DATE_COLUMN)}) AS {_quote(freq)}")
+        params.append(FREQUENCIES[freq])
+        keys.append(_quote(freq))
+    for column in group_by:
+        select.append(_quote(column))
+        keys.append(_quote(column))
+
+    if keys or aggregates:
+        if columns is not None:
+            raise ValueError("columns can not be combined with group_by, freq or aggregates")
+        if not aggregates:
+            select.append("COUNT(*) AS n_sales")
+        for column, funcs in aggregates.items():
+            for func in _list(funcs):
+                if func not in AGGREGATES:
+                    raise ValueError(f"aggregate must be one of {list(AGGREGATES)}")
+                select.append(f"{AGGREGATES[func]}({_quote(column)}) AS {_quote(f'{column}_{func}')}")
+    elif columns is None:
+        select.append("*")
+    else:
+        columns = _list(columns)
+        _check_columns(columns, available, table)
+        select.extend(_quote(c) for c in columns)
+
+    sql = f"SELECT {', '.join(select)} FROM {_quote(table)}"
+    where = []
+    # the dates are stored as text that sorts in date order, so the index on sale_date is used
+    if start is not None:
+        where.append(f"{_quote(DATE_COLUMN)} >= ?")
+        params.append(_date_text(start))
+    if end is not None:
+        where.append(f"{_quote(DATE_COLUMN)} < ?")
+        params.append(_date_text(end))
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    if keys:
+        sql += f" GROUP BY {', '.join(keys)} ORDER BY {', '.join(keys)}"
+    return sql, params
+
+
+def read_sales(columns=None, start=None, end=None, group_by=None, aggregates=None, freq=None,
+               table=SALES_TABLE, database=SALES_DB, chunksize=None):
+    """
+    Read the sales, optionally filtered on a date range and aggregated
+    Parameters:
+    ----------
+    columns : str or list-like, optional
+        only read these columns (without aggregation), by default all columns
+    start : date-like, optional
+        first sale date to include
+    end : date-like, optional
+        sales on or after this date are excluded
+    group_by : str or list-like, optional
+        columns to group the sales on
+    aggregates : dict, optional
+        column name to aggregate ('sum', 'mean', 'min', 'max', 'count') or list of aggregates,
+        the result columns are named <column>_<aggregate>.  By default the sales are counted
+    freq : str, optional
+        roll the sales up by 'year', 'month', 'day' or 'hour' of sale_date
+    table : str, default SALES_TABLE
+    database : str or Path, default SALES_DB
+        file name in DATA_DIR, or an absolute path
+    chunksize : int, optional
+        return an iterator of DataFrames with this many rows
+    Return:
+    ------
+    DataFrame or iterator of DataFrame
+        indexed by sale_id, or by the group keys when aggregated
+    """
+    sql, params = build_query(columns, start, end, group_by, aggregates, freq, table, database)
+    if group_by is not None or freq is not None:
+        index_col = [] if freq is None else [freq]
+        index_col += [] if group_by is None else _list(group_by)
+    elif aggregates is None and (columns is None or "sale_id" in _list(columns)):
+        index_col = "sale_id"
+    else:
+        index_col = None
+    return pd.read_sql(sql, get_connection(database), params=params, index_col=index_col,
+                       chunksize=chunksize)
+
+
+def monthly_sales(start=None, end=None, group_by=None, database=SALES_DB):
+    """
+    Number of sales and revenue per month, see `read_sales`
+    """
+    return read_sales(start=start, end=end, group_by=group_by, freq="month",
+                      aggregates={"Retail Price": ["count", "sum", "mean"]}, database=database)
@@ -0,0 +1,52 @@
+# Time the import of the book/src modules, each in a fresh interpreter, and check
+# that importing them does not load the heavy optional dependencies.
+# Run from the root of the repository:
+#   python scripts/bench_imports.py [--repeat N]
+# Exits with status 1 when a module loads one of the LAZY packages on import.
+import argparse
+import statistics
+import subprocess
+import sys
+
+MODULES = ['src.data', 'src.metric', 'src.feature_selection', 'src.sales_db']
+# only imported when they are used
+LAZY = ('sklearn', 'plotly', 'scipy')
+
+PROBE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+loaded = sorted({{name.split('.')[0] for name in sys.modules}} & set({lazy!r}))
+print(elapsed, ','.join(loaded))
+'''
+
+
+def time_import(module, repeat):
+    """ Median import time in seconds and the lazy packages loaded by the import """
+    times, loaded = [], ''
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, lazy=LAZY)],
+                                cwd='book', capture_output=True, text=True, check=True).stdout.split()
+        times.append(float(output[0]))
+        loaded = output[1] if len(output) > 1 else ''
+    return statistics.median(times), loaded
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--repeat', type=int, default=5, help='imports per module, the median is reported')
+args = parser.parse_args()
+
+# pandas is needed by all the modules, its import time is the floor
+baseline, _ = time_import('pandas', args.repeat)
+print(f"{'pandas (baseline)':24} {baseline * 1000:8.1f} ms")
+failed = False
+for module in MODULES:
+    elapsed, loaded = time_import(module, args.repeat)
+    print(f'{module:24} {elapsed * 1000:8.1f} ms  (+{(elapsed - baseline) * 1000:.1f} ms over pandas)'
+          + (f'  loads {loaded}' if loaded else ''))
+    failed = failed or bool(loaded)
+
+if failed:
+    print(f'Importing the modules should not load {", ".join(LAZY)}')
+    sys.exit(1)
@@ -0,0 +1,42 @@
+# Profile the csv files in book/data and write the schema registry used by load_data.
+# Run from the root of the repository after adding or changing a dataset:
+#   python scripts/build_data_schemas.py
+import importlib.util
+import json
+import sys
+from pathlib import Path
+
+import pandas as pd
+
+sys.path.insert(0, 'book')
+from src.data import SCHEMA_FILE, _file_digest, build_schema  # noqa: E402
+
+data_dir = Path('book/data')
+has_pyarrow = importlib.util.find_spec('pyarrow') is not None
+if not has_pyarrow:
+    print('pyarrow is not installed, the datasets are not checked with the pyarrow engine')
+
+schemas = {}
+for csv_file in sorted(data_dir.glob('*.csv')):
+    try:
+        df = pd.read_csv(csv_file)
+    except (UnicodeDecodeError, pd.errors.ParserError) as e:
+        print(f'Skipping {csv_file.name}: {e}')
+        continue
+    schema = build_schema(df)
+    # load_data ignores the entry once the file changes
+    schema['size'] = csv_file.stat().st_size
+    schema['sha1'] = _file_digest(csv_file)
+
+    # only use the pyarrow engine for files it reads exactly like the default engine
+    schema['pyarrow'] = False
+    if has_pyarrow:
+        try:
+            pd.testing.assert_frame_equal(df, pd.read_csv(csv_file, engine='pyarrow'))
+            schema['pyarrow'] = True
+        except Exception:
+            pass
+    schemas[csv_file.stem] = schema
+    print(f"{csv_file.name}: {len(df.columns)} columns, pyarrow={schema['pyarrow']}")
+
+(data_dir / SCHEMA_FILE).write_text(json.dumps(schemas, indent=1) + '\n')
@@ -1,14 +1,136 @@
+"""
+Build the laptop sales SQLite databases used by the lessons
+    book/data/laptopsales.db        all sales
+    book/data/june_laptopsales.db   only the sales of June
+
+usage: python scripts/setup_laptop_db.py [source.csv]
+"""
 import sqlite3
+import sys
+from pathlib import Path
+
 import pandas as pd
 
-conn = sqlite3.connect('book/data/laptopsales.db')
-sales = pd.read_csv('book/data/LaptopSales.csv')
-sales['sale_date']=pd.to_datetime(sales.Date)
-sales.drop(columns='Date',inplace=True)
+DATA_DIR = Path(__file__).resolve().parents[1] / "book" / "data"
+SOURCE_FILE = DATA_DIR / "LaptopSales.csv"
+DB_FILE = DATA_DIR / "laptopsales.db"
+JUNE_DB_FILE = DATA_DIR / "june_laptopsales.db"
+
+TABLE = "sales"
+INDEX_LABEL = "sale_id"
+# sqlite3 binds each row separately, so a few ten thousand rows per batch
+# keeps memory flat without adding round trips
+CHUNK_SIZE = 50_000
+INDEXED_COLUMNS = (INDEX_LABEL, "sale_date", "Store Postcode", "Customer Postcode")
+
+
+def _quote(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def _prepare_chunk(chunk):
+    """
+    Replace `Date` with `sale_date`, stored as text the way `to_sql` writes datetimes
+    """
+    sale_date = pd.to_datetime(chunk["Date"])
+    chunk = chunk.drop(columns="Date")
+    chunk["sale_date"] = sale_date.dt.strftime("%Y-%m-%d %H:%M:%S")
+    chunk.index.name = INDEX_LABEL
+    return chunk.reset_index()
+
+
+def _rows(chunk):
+    # NaN is stored as NULL, numpy scalars are converted to python values
+    values = chunk.astype(object).where(chunk.notna(), None)
+    return values.itertuples(index=False, name=None)
+
+
+def create_indexes(conn, table=TABLE, columns=INDEXED_COLUMNS, schema="main"):
+    """
+    Index the columns used to filter the sales
+    """
+    for column in columns:
+        name = f"ix_{table}_{column.lower().replace(' ', '_')}"
+        conn.execute(
+            f"CREATE INDEX IF NOT EXISTS {schema}.{_quote(name)} ON {_quote(table)} ({_quote(column)})"
+        )
+
+
+def load_sales(source=SOURCE_FILE, database=DB_FILE, table=TABLE, chunksize=CHUNK_SIZE):
+    """
+    Stream the sales csv into `table` of `database`, replacing the table
+    if it exists.  The load runs in a single transaction with journaling
+    relaxed, the indexes are created afterwards.
+
+    Returns the number of rows loaded
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE IF EXISTS {_quote(table)}")
+        n_rows = 0
+        insert = None
+        for chunk in pd.read_csv(source, chunksize=chunksize):
+            chunk = _prepare_chunk(chunk)
+            if insert is None:
+                # declared as TIMESTAMP, like to_sql does for the datetime column
+                conn.execute(pd.io.sql.get_schema(chunk, table, con=conn, dtype={"sale_date": "TIMESTAMP"}))
+                columns = ", ".join(_quote(c) for c in chunk.columns)
+                marks = ", ".join("?" * len(chunk.columns))
+                insert = f"INSERT INTO {_quote(table)} ({columns}) VALUES ({marks})"
+            conn.executemany(insert, _rows(chunk))
+            n_rows += len(chunk)
+        create_indexes(conn, table)
+        conn.execute("COMMIT")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.execute("PRAGMA synchronous=FULL")
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+    return n_rows
+
+
+def build_month_partition(database=DB_FILE, partition=JUNE_DB_FILE, month=6, table=TABLE):
+    """
+    Copy the sales of `month` (1-12) into `table` of a separate database,
+    replacing the table if it exists.
+
+    Returns the number of rows copied
+    """
+    conn = sqlite3.connect(database, isolation_level=None)
+    try:
+        conn.execute("ATTACH DATABASE ? AS part", (str(partition),))
+        (schema,) = conn.execute(
+            "SELECT sql FROM main.sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        conn.execute("BEGIN")
+        conn.execute(f"DROP TABLE IF EXISTS part.{_quote(table)}")
+        # same column types as the full table
+        conn.execute(schema.replace("CREATE TABLE ", "CREATE TABLE part.", 1))
+        cursor = conn.execute(
+            f"INSERT INTO part.{_quote(table)} SELECT * FROM main.{_quote(table)} "
+            "WHERE CAST(strftime('%m', sale_date) AS INTEGER) = ?",
+            (month,),
+        )
+        n_rows = cursor.rowcount
+        create_indexes(conn, table, schema="part")
+        conn.execute("COMMIT")
+        conn.execute("DETACH DATABASE part")
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return n_rows
 
-sales.to_sql('sales',conn, if_exists='replace',index_label='sale_id')
-# Now create a separate db file just for June sales
-conn = sqlite3.connect('book/data/june_laptopsales.db')
-june_sales = sales[sales.sale_date.dt.month==6]
-sales.to_sql('sales',conn, if_exists='replace',index_label='sale_id')
 
+if __name__ == "__main__":
+    source = sys.argv[1] if len(sys.argv) > 1 else SOURCE_FILE
+    print(f"{load_sales(source)} sales loaded into {DB_FILE.name}")
+    print(f"{build_month_partition()} June sales copied into {JUNE_DB_FILE.name}")